@@ -1,3 +1,3 @@
 #!/bin/sh
 xargpath=Xargon
-python3 xargonmapper.py $xargpath/GRAPHICS.XR1 $xargpath/TILES.XR1 $xargpath/BOARD_??.XR1 $xargpath/MAP.XR1 $xargpath/INTRO.XR1 $xargpath/DEMO*.XR1 $xargpath/STORY.XR1
+python3 xargonmapper.py --jobs 4 --incremental $xargpath/GRAPHICS.XR1 $xargpath/TILES.XR1 $xargpath/BOARD_??.XR1 $xargpath/MAP.XR1 $xargpath/INTRO.XR1 $xargpath/DEMO*.XR1 $xargpath/STORY.XR1
@@ -1,3 +1,3 @@
 #!/bin/sh
 xargpath=Xargon
-python3 xargonmapper.py $xargpath/GRAPHICS.XR2 $xargpath/TILES.XR2 $xargpath/BOARD_??.XR2 $xargpath/MAP.XR2 $xargpath/INTRO.XR2 $xargpath/DEMO*.XR2 $xargpath/STORY.XR2
+python3 xargonmapper.py --jobs 4 --incremental $xargpath/GRAPHICS.XR2 $xargpath/TILES.XR2 $xargpath/BOARD_??.XR2 $xargpath/MAP.XR2 $xargpath/INTRO.XR2 $xargpath/DEMO*.XR2 $xargpath/STORY.XR2
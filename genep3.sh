@@ -1,3 +1,3 @@
 #!/bin/sh
 xargpath=Xargon
-python3 xargonmapper.py $xargpath/GRAPHICS.XR3 $xargpath/TILES.XR3 $xargpath/BOARD_??.XR3 $xargpath/MAP.XR3 $xargpath/INTRO.XR3 $xargpath/DEMO*.XR3 $xargpath/STORY.XR3
+python3 xargonmapper.py --jobs 4 --incremental $xargpath/GRAPHICS.XR3 $xargpath/TILES.XR3 $xargpath/BOARD_??.XR3 $xargpath/MAP.XR3 $xargpath/INTRO.XR3 $xargpath/DEMO*.XR3 $xargpath/STORY.XR3
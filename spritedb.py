@@ -18,489 +18,378 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 """ Module containing the sprite database """
-import traceback
-from PIL import ImageFont, ImageDraw
-
-markupfont = ImageFont.load("font2.pil")
+import sys, traceback, functools, hashlib, json, threading
+from xargongraphics import imagefile, outlinedtext, scaleimage
+from xargonmap import objrecord
+
+class spritetable(object):
+    """ The table of all known Xargon sprites, loaded from a JSON data
+    file. Each entry describes the sprite for a sprite type and one or
+    more sub-types, optionally limited to certain episodes. The table
+    is compiled into a lookup for each episode on first use.
+    """
+    # Keys allowed for each kind of sprite table entry
+    commonkeys = {'name', 'type', 'subtype', 'subtypes', 'episodes',
+        'hidelabel', 'labelpref', 'labeloffs'}
+    kindkeys = {'image': {'image', 'imagestep', 'xoffs', 'yoffs'},
+        'images': {'images', 'contents', 'field', 'offsets'},
+        'font': {'font'}}
+
+    def __init__(self, filename):
+        """ Loads and checks the sprite table from the specified file.
+        Raises an exception describing the first invalid entry found.
+        """
+        with open(filename, 'rb') as tablefile:
+            tabledata = tablefile.read()
+        # Identifies the contents of this table (i.e. for output manifests)
+        self.version = hashlib.sha1(tabledata).hexdigest()
+
+        table = json.loads(tabledata.decode('utf-8'))
+        self.lookups = table['lookups']
+        self.entries = table['sprites']
+        for entrynum, entry in enumerate(self.entries):
+            self.checkentry(entrynum, entry)
+
+        # Compiled lookups, keyed by episode number
+        self.episodes = {}
+
+    def checkentry(self, entrynum, entry):
+        """ Checks that a single sprite table entry is well formed.
+        Raises an exception describing the problem otherwise.
+        """
+        def problem(message):
+            return Exception('Sprite table entry {} ({}): {}'.format(entrynum,
+                entry.get('name', 'unnamed'), message))
+
+        kinds = [kind for kind in self.kindkeys if kind in entry]
+        if len(kinds) != 1:
+            raise problem('needs exactly one of {}'.format(sorted(self.kindkeys)))
+        unknown = set(entry) - self.commonkeys - self.kindkeys[kinds[0]]
+        if unknown:
+            raise problem('unknown keys {}'.format(sorted(unknown)))
+        if not isinstance(entry.get('type'), int):
+            raise problem('needs an integer type')
+        if ('subtype' in entry) == ('subtypes' in entry):
+            raise problem('needs either a subtype or a list of subtypes')
+
+        if 'image' in entry:
+            self.checkimage(entry['image'], problem)
+            if 'imagestep' in entry and not self.stepimage(entry['image'], 0):
+                raise problem('imagestep needs a plain or semi-transparent image')
+        elif 'font' in entry:
+            if entry['font'] not in [1, 2]:
+                raise problem('font must be 1 or 2')
+        elif 'images' in entry:
+            images = entry['images']
+            if isinstance(images, str):
+                if images not in self.lookups:
+                    raise problem("unknown lookup '{}'".format(images))
+                images = self.lookups[images]
+            for spec in images.values():
+                self.checkimage(spec, problem)
+            if 'contents' in entry:
+                self.checkimage(entry['contents'], problem)
+            if not isinstance(getattr(objrecord, entry.get('field', 'appearance'),
+                    None), property):
+                raise problem("unknown field '{}'".format(entry['field']))
+            if 'offsets' in entry and set(entry['offsets']) != set(images):
+                raise problem('offsets do not match the images')
+
+    @staticmethod
+    def checkimage(spec, problem):
+        """ Checks that an image specification is well formed. Raises
+        the exception created by the problem function otherwise.
+        """
+        if isinstance(spec, list):
+            if len(spec) != 2 or not all(isinstance(value, int) for value in spec):
+                raise problem('image {} is not a [record, image] pair'.format(spec))
+        elif isinstance(spec, dict) and 'composite' in spec:
+            if not all(len(part) == 4 for part in spec.get('parts', [])):
+                raise problem('composite parts need [x, y, record, image]')
+        elif isinstance(spec, dict) and 'semitransparent' in spec:
+            if not 0 <= spec['semitransparent'] <= 255:
+                raise problem('transparency must be between 0 and 255')
+            spritetable.checkimage(spec.get('image'), problem)
+        elif not (isinstance(spec, dict) and 'tilegrid' in spec and 'record' in spec):
+            raise problem('unknown image {}'.format(spec))
+
+    @staticmethod
+    def stepimage(spec, step):
+        """ Moves an image specification the given number of images
+        further along its record. Returns the new specification, or None
+        if the image cannot be moved.
+        """
+        if isinstance(spec, list):
+            return [spec[0], spec[1] + step]
+        elif 'semitransparent' in spec:
+            image = spritetable.stepimage(spec['image'], step)
+            if image is not None:
+                return {'semitransparent': spec['semitransparent'], 'image': image}
+        return None
+
+    def compile(self, epnum):
+        """ Compiles the sprite table entries for the given episode into
+        a lookup of sprite descriptions, keyed by sprite type then
+        sub-type. Later entries replace earlier ones for the same
+        sprite. Returns the lookup.
+        """
+        if epnum in self.episodes:
+            return self.episodes[epnum]
+
+        lookup = {}
+        for entry in self.entries:
+            if epnum not in entry.get('episodes', [epnum]):
+                continue
+            description = {key: value for (key, value) in entry.items()
+                if key not in ['name', 'type', 'subtype', 'subtypes',
+                'episodes', 'imagestep']}
+            if 'labeloffs' in description:
+                description['labeloffs'] = tuple(description['labeloffs'])
+            if 'images' in description:
+                images = description['images']
+                if isinstance(images, str):
+                    images = self.lookups[images]
+                description['images'] = {int(value): spec
+                    for (value, spec) in images.items()}
+            if 'offsets' in description:
+                description['offsets'] = {int(value): tuple(offset)
+                    for (value, offset) in description['offsets'].items()}
+
+            subtypes = entry['subtypes'] if 'subtypes' in entry else [entry['subtype']]
+            for (position, subtype) in enumerate(subtypes):
+                subdescription = description
+                if 'imagestep' in entry:
+                    subdescription = dict(description, image=self.stepimage(
+                        entry['image'], position*entry['imagestep']))
+                lookup.setdefault(entry['type'], {})[subtype] = subdescription
+
+        self.episodes[epnum] = lookup
+        return lookup
+
+# Sprite tables loaded so far, keyed by file name
+tables = {}
+
+def loadtable(filename='spritetable.json'):
+    """ Loads the sprite table from the given file, reusing it if it
+    has already been loaded. Returns the spritetable.
+    """
+    if filename not in tables:
+        tables[filename] = spritetable(filename)
+    return tables[filename]
 
 class spritedb(object):
     """ The sprite database is a database of all known Xargon sprites.
     It provides a lookup from the sprite ID and sub-id to the correct
     sprite type.
     """
+    @classmethod
+    def shared(cls, graphics, epnum):
+        """ Provides a sprite database for the given graphics file and
+        episode number, reusing the one created for a previous map where
+        possible. The database is only rebuilt when the active palette
+        of the graphics has changed since it was created. Indexed
+        graphics do not depend on the palette, so they are never
+        rebuilt. The databases are kept on the graphics object, so they
+        are released along with it.
+        """
+        palkey = None if graphics.indexed else graphics.activepal
+        databases = graphics.spritedbs
+        if epnum not in databases or databases[epnum][0] != palkey:
+            databases[epnum] = (palkey, cls(graphics, epnum))
+        return databases[epnum][1]
 
-    def addsprite(self, sprtype, subtype, sprite):
+    def addsprite(self, sprtype, subtype, factory):
         """ Adds a sprite into the database. Creates the applicable
         sub-list as needed.
 
         sprtype -- the sprite type number (from the map object record)
         subtype -- the sprite sub-type number (also from the map object record)
-        sprite -- a sprite object describing how to draw this sprite.
+        factory -- a function that creates the sprite object describing
+                   how to draw this sprite. It is only called the first
+                   time the sprite is needed.
         """
         if sprtype not in self.sprites:
             self.sprites[sprtype] = {}
-        self.sprites[sprtype][subtype] = sprite
+        self.sprites[sprtype][subtype] = factory
 
-    def __init__(self, graphics, epnum):
+    def getsprite(self, sprtype, subtype):
+        """ Looks up the sprite for the given sprite type and sub-type,
+        creating it if this is the first time it is used. Returns None
+        if the sprite is unknown.
+        """
+        if sprtype not in self.sprites or subtype not in self.sprites[sprtype]:
+            return None
+        objsprite = self.sprites[sprtype][subtype]
+        if not isinstance(objsprite, sprite):
+            with self.lock:
+                # Another thread may have created it in the meantime
+                objsprite = self.sprites[sprtype][subtype]
+                if not isinstance(objsprite, sprite):
+                    objsprite = objsprite()
+                    self.sprites[sprtype][subtype] = objsprite
+        return objsprite
+
+    def __init__(self, graphics, epnum, table=None):
         """ Loads the sprite database according to the provided
-        graphics file and episode number.
+        graphics file and episode number. Sprites are only described
+        here; each one is created when a map first uses it.
+
+        graphics -- the Xargon graphics file to take sprite images from
+        epnum -- the episode number of the maps to be drawn
+        table -- the spritetable describing the known sprites. The
+                 default table file is used if not provided.
         """
+        if table is None:
+            table = loadtable()
         self.sprites = {}
-
-        # Manually-defined sprites (i.e. special handling needed
-        self.addsprite(0, 4, sprite(graphics.records[6].images[9], yoffs=-8)) # Player
-
-        # Keys and Locks:
-        for i in range (4):
-            self.addsprite(9, i, sprite(graphics.records[31].images[32+i],
-                xoffs=6, yoffs=8, hidelabel=True)) # Lock
-            self.addsprite(20, i, sprite(graphics.records[31].images[i*8])) # Key
-
-        # Text sprites:
-        self.addsprite(6, 0, textsprite(ImageFont.load("font2.pil"), graphics))
-        self.addsprite(7, 0, textsprite(ImageFont.load("font1.pil"), graphics))
-
-        # Variant of Compound and semi-transparent for hidden platform(s)
-        self.addsprite(11, 0, variablesprite({
-            2: graphics.semitransparent(
-               graphics.compositeimage((16, 32), [(0, 0, 8, 18),
-               (0, 16, 8, 21)]), 128),
-            4: graphics.semitransparent(
-               graphics.compositeimage((48, 32), [(0, 0, 11, 1),
-               (16, 0, 11, 1), (0, 16, 11, 2), (16, 16, 11, 2),
-               (32, 0, 11, 19), (32, 16, 11, 19)]), 128),
-            6: graphics.semitransparent(
-               graphics.compositeimage((32, 16), [(0, 0, 25, 14),
-               (16, 0, 25, 15)]), 128),
-            7: graphics.semitransparent(
-               graphics.compositeimage((32, 16), [(0, 0, 51, 10),
-               (16, 0, 51, 11)]), 128) }
-             ))
-
-        # Simple sprite mapping. Stage sprites, then Map sprites
-        for (sprtype, subtype, recnum, imagenum) in [(0, 0, 6, 10), # Menu Player
-                (4, 0, 40, 20), # Mine
-                (16, 0, 36, 13), (16, 1, 36, 13), # Elevator Platform
-                (18, 0, 36, 0), # Manual Elevator
-                (21, 0, 37, 33), # Health Pickup
-                (22, 0, 30, 28), # Emerald
-                (24, 0, 34, 0), # EPIC Points
-                (28, 6, 40, 21), # Diving Pod
-                (28, 0, 30, 15), (28, 4, 30, 17), (28, 5, 30, 18),
-                (28, 7, 30, 20), (28, 8, 30, 21), (28, 9, 30, 22), # Powerups
-                (28, 1, 30, 16), # Purple Key
-                (30, 0, 51, 9), (30, 1, 51, 8), # Ceiling Switch
-                (31, 0, 51, 14), (31, 1, 51, 14), # Hidden Spikey Creature
-                (33, 28, 37, 28), # Fireball
-                (38, 0, 30, 50), (38, 1, 30, 51), (38, 2, 30, 52), # Menu Bullets
-                (40, 0, 30, 62), # Star
-                (42, 0, 37, 29), # Green Gem
-                (42, 1, 37, 30), # Purple Gem
-                (42, 2, 37, 31), # Red Gem
-                (42, 3, 37, 32), # Yellow Gem
-                (44, 0, 15, 2), # Stalagtite
-                (45, 0, 36, 19), # Boulder Trap
-                (48, 0, 40, 16), (48, 1, 40, 17), # Bubbles
-                (51, 0, 36, 33), # Clouds
-                (72, 0, 55, 0), (72, 1, 55, 1), (72, 2, 55, 2), # Pillar
-                (72, 7, 55, 3), (72, 8, 55, 4), (72, 9, 55, 5), (72, 10, 55, 6), # Foliage
-                (72, 4, 36, 35), (72, 11, 36, 36), # Exit Sign
-                (72, 13, 38, 3), (72, 14, 38, 4), # Reactors
-                (72, 15, 38, 5), (72, 16, 38, 6), # To Reactor
-                (74, 0, 59, 9), # Ceiling Turret
-                (78, 0, 50, 0), # Climbing Monster
-                (81, 0, 39, 22), # Water Bed Creature
-                (84, 0, 30, 31), (84, 1, 30, 32), (84, 2, 30, 33), # Artefacts
-                (87, 0, 38, 0), (87, 1, 38, 1), # The Mighty Xargon!
-                (88, 0, 47, 18), (88, 1, 47, 19),
-                (88, 2, 47, 20), (88, 3, 47, 21), (88, 6, 47, 24) # Map images
-                ]:
-            self.addsprite(sprtype, subtype, sprite(graphics.records[recnum].images[imagenum]))
-
-        # Simple mapping to hide info label:
-        for (sprtype, subtype, recnum, imagenum) in [
-                (13, 0, 36, 2), # Springboard
-                (49, 0, 48, 12), # Torch
-                ]:
-            self.addsprite(sprtype, subtype, sprite(graphics.records[recnum].images[imagenum],
-                hidelabel=True))
-
-        # Map Images that need alignment:
-        for (sprtype, subtype, recnum, imagenum) in [
-                (5, 0, 47, 8), # Map Player
-                (88, 4, 47, 22), (88, 5, 47, 23)]:
-            self.addsprite(sprtype, subtype, sprite(
-                graphics.records[recnum].images[imagenum], xoffs=4))
-        self.addsprite(88, -1, sprite(
-            graphics.records[47].images[16], xoffs=2, yoffs=2))
-
-        # Xargon's castle:
-        if epnum == 3:
-            self.addsprite(88, 7,  sprite(graphics.records[47].images[25], yoffs=6, xoffs=4))
-            self.addsprite(88, 8,  sprite(graphics.records[47].images[26], yoffs=6, xoffs=10))
-            self.addsprite(88, 9,  sprite(graphics.records[47].images[27]))
-            self.addsprite(88, 10, sprite(graphics.records[47].images[28], xoffs=4))
-            self.addsprite(88, 11, sprite(graphics.records[47].images[29], xoffs=10))
-            self.addsprite(88, 12, sprite(graphics.records[47].images[30]))
-
-        # Silvertongue
-        for i in range (25):
-            self.addsprite(23, i, sprite(graphics.records[45].images[1]))
-
-        # Crushing Ceilings:
-        for i in range (16):
-            self.addsprite(15, i, sprite(graphics.records[36].images[6]))
-
-        # Illusionary Walls:
-        self.addsprite(72, 3, sprite(graphics.semitransparent(
-                graphics.records[20].images[8], 160) ))
-        self.addsprite(72, 5, sprite(graphics.semitransparent(
-                graphics.records[11].images[23], 160) ))
-        self.addsprite(72, 6, sprite(graphics.semitransparent(
-                graphics.records[19].images[15], 160) ))
-        self.addsprite(72, 12, sprite(graphics.semitransparent(
-                graphics.records[19].images[16], 160) ))
-
-        # Treasures (+ contents)
-        treasurelookup = {0 : graphics.records[37].images[24],
-            1 : graphics.records[37].images[25],
-            2 : graphics.records[37].images[26],
-            3 : graphics.records[37].images[27] }
-
-        for (sprtype, subtype, crecnum, cimagenum) in [
-                (26, 0, 37, 33), # Health
-                (26, 1, 37, 2), # Grapes
-                (26, 2, 37, 6), # Cherry
-                (26, 3, 37, 8), # Strawberries
-                (26, 4, 37, 14), # Orange
-                (26, 5, 37, 3), # Epic Disk
-                (26, 6, 31, 0), # Yellow Key
-                (26, 7, 31, 8), # Green Key
-                (26, 8, 31, 16), # Red Key
-                (26, 9, 31, 24), # Blue Key
-                (26, 10, 30, 21), # High-jump shoes
-                (26, 11, 30, 28), # Emerald
-                (26, 12, 48, 2), # Nitro!
-                (26, 13, 36, 29) # Empty
-                ]:
-            self.addsprite(sprtype, subtype, variablesprite(treasurelookup,
-                contents=graphics.records[crecnum].images[cimagenum]))
-
-        # Pickup Switches:
-        self.addsprite(12, 0, variablesprite({
-            0 : graphics.records[30].images[19],
-            1 : graphics.records[51].images[0]},
-            labelpref="TR ", labeloffs = (0, 4)) )
-
-        # Toggle Switches:
-        self.addsprite(29, 0, sprite(graphics.records[36].images[23],
-            labelpref = "SW "))
-        self.addsprite(29, 1, sprite(graphics.records[36].images[24],
-            labelpref = "SW "))
-
-        # Timers:
-        for i in [30, 40, 50, 60]:
-            self.addsprite(73, i, sprite(graphics.records[30].images[19],
-                labelpref="Timer ", labeloffs = (-4, 4)) )
-
-        # Menu Flame Jets:
-        self.addsprite(47, 0, variablesprite({
-            6 : graphics.records[48].images[3],
-            8 : graphics.records[48].images[4]},
-            field='info', hidelabel=True))
-
-        # Bouncing Balls:
-        for i in range(2):
-            self.addsprite(46, i, variablesprite({
-                0 : graphics.records[51].images[4],
-                1 : graphics.records[51].images[5],
-                2 : graphics.records[51].images[6],
-                3 : graphics.records[51].images[7]},
-                field='info', hidelabel=True))
-
-        # Spikes:
-        self.addsprite(59, 0, variablesprite({
-            0 : graphics.records[36].images[28],
-            1 : graphics.records[36].images[32]},
-            field='variant', hidelabel=True))
-
-        # Ceiling Spear
-        for i in range(3):
-            self.addsprite(43, i, variablesprite({
-                0 : graphics.records[36].images[9],
-                1 : graphics.records[36].images[12]},
-                offsets={0: (0, 0), 1:(0, -4) },
-                field='variant', hidelabel=True))
-
-        # Snake Face
-        self.addsprite(50, 0, variablesprite({
-            0 : graphics.records[60].images[1],
-            1 : graphics.records[60].images[4]},
-            offsets={0: (0, 0), 1:(-8, 0) },
-            hidelabel = True))
-
-
-        # Monsters:
-        # Assumed Convention: > 0 -- Right, <= 0 -- Left
-        # Clawface Monster
-        self.addsprite(25, 0, variablesprite({
-            0 : graphics.records[35].images[2],
-            2 : graphics.records[35].images[10],
-            } ))
-
-        # Brute
-        self.addsprite(55, 0, variablesprite({
-            -4 : graphics.records[61].images[12],
-            -3 : graphics.records[61].images[11],
-            -2 : graphics.records[61].images[10],
-            -1 : graphics.records[61].images[9],
-            0 : graphics.records[61].images[8],
-            1 : graphics.records[61].images[0],
-            2 : graphics.records[61].images[1],
-            3 : graphics.records[61].images[2],
-            4 : graphics.records[61].images[3]
-            } ))
-
-        # Centipede Monster
-        self.addsprite(52, 7, sprite(graphics.compositeimage((76, 22), [(0, 0, 52, 0),
-            (16, 5, 52, 1), (24, 5, 52, 2), (32, 5, 52, 3), (40, 5, 52, 4),
-            (48, 5, 52, 5), (56, 5, 52, 6), (64, 7, 52, 7)] )))
-
-        # Alien Rat Thing
-        self.addsprite(53, 0, variablesprite({
-            -1 : graphics.records[58].images[2],
-            0 : graphics.records[58].images[1],
-            2 : graphics.records[58].images[6]
-            } ))
-
-        if epnum == 3:
-            # Snake-like thing
-            self.addsprite(54, 0, variablesprite({
-                -3 : graphics.records[42].images[3],
-                -2 : graphics.records[42].images[2],
-                -1 : graphics.records[42].images[1],
-                0 : graphics.records[42].images[0],
-                2 : graphics.records[42].images[5],
-                4 : graphics.records[42].images[6]
-                } ))
-
-        if epnum == 2:
-            # Goo Monster
-            self.addsprite(56, 0, sprite(graphics.records[46].images[2]))
-
-        if epnum != 1:
-            # Mini Dino
-            self.addsprite(58, 0, variablesprite({
-                -2 : graphics.records[56].images[6],
-                -1 : graphics.records[56].images[5],
-                0 : graphics.records[56].images[4],
-                1 : graphics.records[56].images[1],
-                2 : graphics.records[56].images[0],
-                } ))
-
-        # Flying Robots
-        self.addsprite(60, 0, sprite(graphics.records[59].images[1]))
-        self.addsprite(60, 1, sprite(graphics.records[59].images[4]))
-        self.addsprite(60, 2, sprite(graphics.records[59].images[7]))
-
-        # Shrimp
-        self.addsprite(64, 0, variablesprite({
-            0 : graphics.records[39].images[2],
-            2 : graphics.records[39].images[10],
-            } ))
-
-        # Evil Cloak Guy
-        for i in range(2):
-            self.addsprite(65, i, variablesprite({
-                0 : graphics.records[54].images[5],
-                2 : graphics.records[54].images[0],
-                } ))
-
-        # Eel
-        self.addsprite(67, 0, variablesprite({
-            -3 : graphics.records[39].images[14],
-            0 : graphics.records[39].images[15],
-            2 : graphics.records[39].images[20]
-            } ))
-
-        # Big Fish
-        self.addsprite(68, 0, variablesprite({
-            -3 : graphics.records[40].images[8],
-            -2 : graphics.records[40].images[7],
-            0 : graphics.records[40].images[6],
-            2 : graphics.records[40].images[11],
-            3 : graphics.records[40].images[12],
-            4 : graphics.records[40].images[13]
-            } ))
-
-
-        if epnum != 1:
-            # Bat
-            self.addsprite(69, 0, sprite(graphics.records[56].images[8]))
-
-            self.addsprite(70, 0, variablesprite({
-                0 : graphics.records[63].images[4],
-                2 : graphics.records[63].images[1],
-                } ))
-
-
-        # Skull Slug!
-        if epnum != 2:
-            self.addsprite(75, 0, variablesprite({
-                -1 : graphics.records[62].images[2],
-                0 : graphics.records[62].images[0],
-                1 : graphics.records[62].images[5],
-                2 : graphics.records[62].images[3]
-                }, hidelabel=True ))
-
-        # Bee!
-        self.addsprite(77, 0, variablesprite({
-            -2 : graphics.records[32].images[1],
-            -1 : graphics.records[32].images[1],
-            0 : graphics.records[32].images[0],
-            1 : graphics.records[32].images[3],
-            2 : graphics.records[32].images[2]
-            } ))
-
-        # Spider!
-        self.addsprite(79, 0, variablesprite({
-            -3 : graphics.records[43].images[12],
-            -2 : graphics.records[43].images[11],
-            -1 : graphics.records[43].images[10],
-            0 : graphics.records[43].images[9],
-            1 : graphics.records[43].images[0],
-            2 : graphics.records[43].images[1],
-            3 : graphics.records[43].images[2],
-            4 : graphics.records[43].images[3]
-            } ))
-
-        # Robot with Treads
-        self.addsprite(82, 0, variablesprite({
-            -4 : graphics.records[59].images[21],
-            -3 : graphics.records[59].images[21],
-            -2 : graphics.records[59].images[20],
-            -1 : graphics.records[59].images[19],
-            0 : graphics.records[59].images[18],
-            1 : graphics.records[59].images[14],
-            2 : graphics.records[59].images[15],
-            3 : graphics.records[59].images[16],
-            4 : graphics.records[59].images[17],
-            } ))
-
-        # Small fish
-        self.addsprite(83, 0, variablesprite({
-            0 : graphics.records[40].images[22],
-            2 : graphics.records[40].images[26]
-            } ))
-
-        # Pickups appear to be in the same order as their corresponding record.
-        # There are two types of pickups: normal and hidden.
-        for subtype in range(24):
-            self.addsprite(33, subtype, sprite(graphics.records[37].images[subtype],
-                hidelabel=True))
-            self.addsprite(73, subtype, sprite(graphics.semitransparent(
-                graphics.records[37].images[subtype], 128) ))
-
-        # Special case for 73, Variant 4 appears to be the pickup item.
-        # Other variants appear to be:
-        # 0 : Unused??
-        # 1 : Flaming Face Jet (Down) (Invisible)
-        # 2 : Flaming Lava Jet (Up) (Invisible)
-        # 3 : Robot Spawner
-        # 5 : Slug Spawner
-        # These alternate forms only appear to show up for subtypes 0 and 1,
-        # so they will be added just for these two numbers:
-
-        # Episode 2 doesn't have the skull slug, so we need an alternate
-        # sprite so it doesn't crash.
-        if epnum != 2:
-            slugspawner = graphics.compositeimage((32, 14),
-                    [(2, 0, 62, 2), (-3, 0, 62, 0)])
-        else:
-            slugspawner = graphics.records[30].images[19]
-
-        for i in range(2):
-            self.addsprite(73, i, variablesprite({
-                0 : graphics.records[30].images[19],
-                1 : graphics.records[30].images[19],
-                2 : graphics.records[30].images[19],
-                3 : graphics.compositeimage((32, 32), [(0, 0, 59, 1),
-                   (16, 0, 59, 4), (8, 12, 59, 1)]),
-                4 : graphics.semitransparent(
-                    graphics.records[37].images[i], 128),
-                5 : slugspawner},
-                field='variant', hidelabel=True))
-
-        # Story Scenes:
-        if epnum == 1:
-            for subtype in range(24):
-                self.addsprite(85, subtype, sprite(graphics.records[56].images[subtype]))
-                self.addsprite(86, subtype, sprite(graphics.records[57].images[subtype]))
-        elif epnum == 3:
-            # Fake sprite for the ending scene (which does not appear to have a sprite OR use Tiles):
-            tilelist = []
-            for x in range(10):
-                for y in range(10):
-                    tilelist.append( (x*16, y*16, 57, x + 10*y) )
-            self.addsprite(1000, 0, sprite(graphics.compositeimage((160, 160), tilelist)))
-
-        # Empty sprites:
-        # -------------------------
-        # For future reference, possible meanings are:
-        # 17-# (and other numbers): Start? Warp?
-        # 63-# Start?
-        for sprtype in [17, 63]:
-            for subtype in range(-1, 11):
-                self.addsprite(sprtype, subtype, sprite(graphics.records[30].images[19],
-                    hidelabel=True))
-
-        for sprtype, subtype in [
-                (19,0), # Map label? (TODO: Implement via compound sprite?)
-                (8, 0), (8, 1), # Switchable Pillar Wall
-                ]:
-            self.addsprite(sprtype, subtype, sprite(graphics.records[30].images[19]))
-
-        for sprtype, subtype in [
-                (71,0), (71,1), # Sign & Popup Message?
-                (9, -1) # Locked Map Gate
-                ]:
-            self.addsprite(sprtype, subtype, sprite(graphics.records[30].images[19],
-                hidelabel=True))
-
-
-        # Warp Doorways:
-        self.addsprite(61, 0, sprite(graphics.records[30].images[19],
-            labeloffs = (4, 4))) # Out Door
-        self.addsprite(62, 0, sprite(graphics.records[30].images[19],
-            labelpref='To ', labeloffs = (0, 4))) # In Door
-
+        # Debug sprites for unknown objects, keyed by type and size
+        self.debugsprites = {}
+        # Shrunk copies of the images drawn at lower resolutions, keyed
+        # by scale then the id of the full size image. Each entry keeps
+        # a reference to the full size image so the id stays valid.
+        self.scaledimages = {}
+        # Guards the creation of sprites when drawing from several threads
+        self.lock = threading.Lock()
         # Cache a reference to the graphics object for future use
         self.graphics = graphics
 
-    def drawsprite(self, mappicture, objrec, mapdata):
-        """ Draws the sprite described by the map object record into the
-        map image.
+        for (sprtype, subtypes) in table.compile(epnum).items():
+            for (subtype, description) in subtypes.items():
+                self.addsprite(sprtype, subtype,
+                    functools.partial(self.createsprite, description))
+
+    def loadimage(self, spec):
+        """ Creates the image described by an image specification from
+        the sprite table. Returns the image.
+        """
+        if isinstance(spec, list):
+            (recnum, imagenum) = spec
+            return self.graphics.records[recnum].images[imagenum]
+        elif 'composite' in spec:
+            return self.graphics.compositeimage(tuple(spec['composite']),
+                [tuple(part) for part in spec['parts']])
+        elif 'semitransparent' in spec:
+            return self.graphics.semitransparent(self.loadimage(spec['image']),
+                spec['semitransparent'])
+        else:
+            # A grid of 16x16 images, numbered across then down
+            (columns, rows) = spec['tilegrid']
+            return self.graphics.compositeimage((columns*16, rows*16),
+                [(x*16, y*16, spec['record'], x + columns*y)
+                for x in range(columns) for y in range(rows)])
+
+    def createsprite(self, description):
+        """ Creates the sprite object for a compiled sprite table entry.
+        Returns the sprite.
+        """
+        if 'font' in description:
+            return textsprite(self.graphics.getfont(description['font']),
+                self.graphics)
+
+        options = {key: description[key] for key in
+            ['xoffs', 'yoffs', 'hidelabel', 'labelpref', 'labeloffs']
+            if key in description}
+        # Info labels use the small font
+        options['labelfont'] = self.graphics.getfont(2)
+        if 'images' in description:
+            images = {value: self.loadimage(spec)
+                for (value, spec) in description['images'].items()}
+            if 'contents' in description:
+                options['contents'] = self.loadimage(description['contents'])
+            for key in ['field', 'offsets']:
+                if key in description:
+                    options[key] = description[key]
+            return variablesprite(images, **options)
+        else:
+            return sprite(self.loadimage(description['image']), **options)
+
+    def preload(self):
+        """ Creates every sprite in this database up front, rather than
+        on first use. Returns a list of descriptions of the sprites that
+        could not be created (i.e. due to missing images).
+        """
+        problems = []
+        for (sprtype, subtypes) in sorted(self.sprites.items()):
+            for subtype in sorted(subtypes):
+                try:
+                    self.getsprite(sprtype, subtype)
+                except Exception as err:
+                    problems.append("Sprite {}, Type {}: {!r}".format(
+                        sprtype, subtype, err))
+        return problems
+
+    def resolvesprite(self, objrec, mapdata, scale=1):
+        """ Works out how to draw the sprite described by the map object
+        record. Safe to use from several threads at once. Returns a list
+        of (image, position, mask) tuples to paste into the map image,
+        which is empty if the sprite could not be drawn.
 
-        mappicture -- the in-progress map image
         objrec -- the object record for the sprite to be drawn
         mapdata -- a reference back to the data that is being mapped.
+        scale -- if more than 1, the images and positions are shrunk to
+                 draw into a map this many times smaller.
         """
         try:
-            # Create a debug sprite when a sprite is unknown
-            if objrec.sprtype not in self.sprites or \
-                    objrec.subtype not in self.sprites[objrec.sprtype]:
-                self.addsprite(objrec.sprtype, objrec.subtype, sprite(
-                    self.graphics.debugimage(objrec.sprtype, objrec.subtype,
-                    objrec.width, objrec.height)))
-
-            # Draw the sprite
-            self.sprites[objrec.sprtype][objrec.subtype].draw(mappicture, objrec, mapdata)
+            objsprite = self.getsprite(objrec.sprtype, objrec.subtype)
+            if objsprite is None:
+                # Create a debug sprite when a sprite is unknown. These
+                # are kept apart from the known sprites, as the database
+                # may be shared by several maps.
+                debugkey = (objrec.sprtype, objrec.subtype, objrec.width,
+                    objrec.height)
+                with self.lock:
+                    if debugkey not in self.debugsprites:
+                        self.debugsprites[debugkey] = sprite(
+                            self.graphics.debugimage(*debugkey),
+                            labelfont=self.graphics.getfont(2))
+                objsprite = self.debugsprites[debugkey]
+
+            items = objsprite.resolve(objrec, mapdata)
+            if scale > 1:
+                items = [self.scaleitem(item, scale) for item in items]
+            return items
 
         except:
             print("Problem with Sprite {}, Type {}, Appearance {}, Variant {} at ({}, {})".format(
                 objrec.sprtype, objrec.subtype, objrec.appearance, objrec.variant,
                 objrec.x, objrec.y))
             traceback.print_exc()
+            return []
+
+    def scaleitem(self, item, scale):
+        """ Shrinks an (image, position, mask) tuple resolved for a full
+        size map to draw into a map the given number of times smaller.
+        Each image is only shrunk the first time it is used at a scale.
+        """
+        (image, (x, y), mask) = item
+        return (self.scaledimage(image, scale), (x // scale, y // scale),
+            self.scaledimage(mask, scale))
+
+    def scaledimage(self, image, scale):
+        """ Returns the shrunk copy of the given image for the given
+        scale, creating it on first use. Colours and missing masks are
+        returned as they are.
+        """
+        if image is None or isinstance(image, (int, tuple)):
+            return image
+        scaledimages = self.scaledimages.setdefault(scale, {})
+        if id(image) not in scaledimages:
+            with self.lock:
+                if id(image) not in scaledimages:
+                    scaledimages[id(image)] = (image, scaleimage(image, scale))
+        return scaledimages[id(image)][1]
+
+    def drawsprite(self, mappicture, objrec, mapdata, scale=1):
+        """ Draws the sprite described by the map object record into the
+        map image.
+
+        mappicture -- the in-progress map image
+        objrec -- the object record for the sprite to be drawn
+        mapdata -- a reference back to the data that is being mapped.
+        scale -- as for resolvesprite
+        """
+        for (image, position, mask) in self.resolvesprite(objrec, mapdata, scale):
+            mappicture.paste(image, position, mask)
 
 
 class sprite(object):
@@ -508,7 +397,7 @@ class sprite(object):
     contains enough information to render the sprite into the map.
     """
     def __init__(self, image, xoffs=0, yoffs=0, hidelabel=False,
-            labelpref='', labeloffs=(-8, -8)):
+            labelpref='', labeloffs=(-8, -8), labelfont=None):
         """ Initializes this sprite according to the following info:
 
         image -- the PIL image for the sprite
@@ -521,6 +410,8 @@ class sprite(object):
         labeloffs -- a tuple specifying how far from the upper-left
                      corner of the sprite to start the upper-left corner
                      of the label text.
+        labelfont -- the glyphfont to draw labels with. Labels are not
+                     drawn without a font.
         """
 
         self.image = image
@@ -529,6 +420,7 @@ class sprite(object):
         self.hidelabel = hidelabel
         self.labelpref = labelpref
         self.labeloffs = labeloffs
+        self.labelfont = labelfont
 
     def draw(self, mappicture, objrec, mapdata):
         """ Draws this sprite into the in-progress map image:
@@ -537,26 +429,41 @@ class sprite(object):
         objrec -- the object record for the sprite to be drawn
         mapdata -- a reference back to the data that is being mapped.
         """
+        for (image, position, mask) in self.resolve(objrec, mapdata):
+            mappicture.paste(image, position, mask)
+
+    def resolve(self, objrec, mapdata):
+        """ Works out how to draw this sprite for the given object,
+        without changing this sprite. Returns a list of (image, position,
+        mask) tuples, in the order they should be pasted into the map
+        image.
+
+        objrec -- the object record for the sprite to be drawn
+        mapdata -- a reference back to the data that is being mapped.
+        """
+        return self.resolveimage(self.image, self.xoffs, self.yoffs, objrec)
 
+    def resolveimage(self, image, xoffs, yoffs, objrec):
+        """ Works out how to draw the given sprite image, shifted by the
+        given offsets, along with the info label for the object.
+        Returns a list of (image, position, mask) tuples.
+        """
         # When pasting masked images, need to specify the mask for the paste.
         # RGBA images can be used as their own masks.
-        mappicture.paste(self.image, (objrec.x +self.xoffs,
-            objrec.y +self.yoffs), self.image)
+        items = [(image, (objrec.x +xoffs, objrec.y +yoffs), image)]
 
-        if objrec.info > 0 and objrec.info < 90 and not self.hidelabel:
+        if objrec.info > 0 and objrec.info < 90 and not self.hidelabel and \
+                self.labelfont is not None:
             text = "{}{}".format(self.labelpref, objrec.info)
 
-            # Draw the text 5 times to create an outline
-            # (4 x black then 1 x white)
-            pen = ImageDraw.Draw(mappicture)
-            for offset, colour in [( (-1,-1), (0,0,0) ),
-                    ( (-1,1), (0,0,0) ),
-                    ( (1,-1), (0,0,0) ),
-                    ( (1,1), (0,0,0) ),
-                    ( (0,0), (255,255,255) )]:
-                pen.text( (objrec.x +self.xoffs +offset[0] +self.labeloffs[0],
-                    objrec.y +self.yoffs +offset[1] +self.labeloffs[0]),
-                    text, font=markupfont, fill=colour)
+            # Paste the pre-rendered outlined text, which starts one
+            # pixel up and left of the text itself
+            label = outlinedtext(text, self.labelfont)
+            if label is not None:
+                items.append((label,
+                    (objrec.x +xoffs -1 +self.labeloffs[0],
+                    objrec.y +yoffs -1 +self.labeloffs[0]), label))
+        return items
 
 
 class textsprite(sprite):
@@ -579,25 +486,24 @@ class textsprite(sprite):
         self.font = font
         self.graphics = graphics
 
-    def draw(self, mappicture, objrec, mapdata):
-        """ Draws this sprite into the in-progress map image:
+    def resolve(self, objrec, mapdata):
+        """ Works out how to draw this text for the given object. Returns
+        a list of (colour, position, mask) tuples.
 
-        mappicture -- the in-progress map image
         objrec -- the object record for the sprite to be drawn
         mapdata -- a reference back to the data that is being mapped.
         """
-
-        pen = ImageDraw.Draw(mappicture)
+        mask = self.font.getmask(mapdata.getstring(objrec.stringref))
+        if mask is None:
+            return []
 
         if objrec.appearance == 8:
             # Simulate multi-colour appearance by creating a fake shadow effect
-            pen.text((objrec.x, objrec.y), mapdata.getstring(objrec.stringref),
-                    font=self.font, fill=self.graphics.getcolour(14))
-            pen.text((objrec.x-1, objrec.y), mapdata.getstring(objrec.stringref),
-                    font=self.font, fill=self.graphics.getcolour(6))
+            return [(self.graphics.getink(14), (objrec.x, objrec.y), mask),
+                (self.graphics.getink(6), (objrec.x-1, objrec.y), mask)]
         else:
-            pen.text((objrec.x, objrec.y), mapdata.getstring(objrec.stringref),
-                    font=self.font, fill=self.graphics.getcolour(objrec.appearance))
+            return [(self.graphics.getink(objrec.appearance),
+                (objrec.x, objrec.y), mask)]
 
 
 class variablesprite(sprite):
@@ -607,7 +513,8 @@ class variablesprite(sprite):
     """
 
     def __init__(self, imagelookup, contents=None, field='appearance',
-            offsets=None, hidelabel=False, labelpref='', labeloffs=(-8, -8)):
+            offsets=None, hidelabel=False, labelpref='', labeloffs=(-8, -8),
+            labelfont=None):
         """ Initializes this variable sprite according to the following info:
 
         imagelookup -- A dictionary of PIL images to use, keyed by
@@ -625,6 +532,8 @@ class variablesprite(sprite):
         labeloffs -- a tuple specifying how far from the upper-left
                      corner of the sprite to start the upper-left corner
                      of the label text.
+        labelfont -- the glyphfont to draw labels with. Labels are not
+                     drawn without a font.
         """
 
         # Create a lookup of possible boxes
@@ -637,22 +546,47 @@ class variablesprite(sprite):
         self.hidelabel = hidelabel
         self.labelpref = labelpref
         self.labeloffs = labeloffs
+        self.labelfont = labelfont
 
-    def draw(self, mappicture, objrec, mapdata):
-        """ Draws this sprite into the in-progress map image:
+    def resolve(self, objrec, mapdata):
+        """ Works out how to draw this sprite for the given object,
+        without changing this sprite. Returns a list of (image, position,
+        mask) tuples.
 
-        mappicture -- the in-progress map image
         objrec -- the object record for the sprite to be drawn
         mapdata -- a reference back to the data that is being mapped.
         """
 
-        # Pick the correct image then use the parent routine to draw the box
-        self.image = self.types[objrec.__dict__[self.field]]
+        # Pick the correct image then use the parent routine for the box
+        value = getattr(objrec, self.field)
+        image = self.types[value]
+        (xoffs, yoffs) = (self.xoffs, self.yoffs)
         if self.offsets != None:
-            (self.xoffs, self.yoffs) = self.offsets[objrec.__dict__[self.field]]
-        super(variablesprite, self).draw(mappicture, objrec, mapdata)
+            (xoffs, yoffs) = self.offsets[value]
+        items = self.resolveimage(image, xoffs, yoffs, objrec)
 
         # Place contents immediately above the current sprite
         if self.contents != None:
-            mappicture.paste(self.contents, (objrec.x +self.xoffs,
-                objrec.y +self.yoffs - self.contents.size[1]), self.contents)
+            items.append((self.contents, (objrec.x +xoffs,
+                objrec.y +yoffs - self.contents.size[1]), self.contents))
+        return items
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("""Usage: python spritedb.py [Graphics File(s)]
+
+Checks the sprite table (spritetable.json) and creates every sprite it
+describes for the episode of each specified GRAPHICS file, listing any
+sprites that could not be created.
+""")
+    else:
+        for filename in sys.argv[1:]:
+            graphics = imagefile(filename, lazy=True)
+            sprites = spritedb(graphics, graphics.epnum)
+            problems = sprites.preload()
+            print("Episode {}: {} sprites, {} problems".format(graphics.epnum,
+                sum(len(subtypes) for subtypes in sprites.sprites.values()),
+                len(problems)))
+            for problem in problems:
+                print("  " + problem)
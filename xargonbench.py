@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# Copyright 2012, 2021 Ryan Armstrong
+#
+# This file is part of Xargon Mapper.
+#
+# Xargon Mapper Mapper is free software: you can redistribute
+# it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Xargon Mapper Mapper is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Xargon Mapper Mapper.
+# If not, see <http://www.gnu.org/licenses/>.
+""" Benchmarks for the slower stages of the Xargon Mapper, comparing
+the current implementation against the original approach.
+"""
+
+import sys, io, time
+from PIL import Image
+from xargongraphics import imagefile, imagerecord, indexedcanvas, keyedimage
+from xargontiles import tilefile
+from xargonmap import xargonmap
+from xargonmapper import xargonmapper, mappalette, saveimage
+
+def legacymaskimage(inimage):
+    """ The original per-pixel implementation of imagerecord.maskimage,
+    kept for comparison purposes.
+    """
+    tempmask = Image.new('L', inimage.size, 255)
+    maskdata = list(tempmask.getdata())
+    outimage = inimage.convert("RGBA")
+
+    for pos, value in enumerate(inimage.getdata()):
+        if value == 0:
+            maskdata[pos] = 0
+
+    tempmask.putdata(maskdata)
+    outimage.putalpha(tempmask)
+    return outimage
+
+def legacypastetiles(baseimage, graphics, tiledata, mapdata):
+    """ The original tile by tile implementation of
+    xargonmapper.pastetiles, kept for comparison purposes. Indexed tiles
+    are pasted with their own mask, as the original RGBA tiles were.
+    """
+    for index, tileval in enumerate(mapdata.tiles):
+        # Remember: maps are height first
+        (x, y) = (index//64, index%64)
+        tileimg = tiledata.gettile(graphics, tileval)
+        if isinstance(tileimg, keyedimage):
+            baseimage.paste(tileimg.image, (x*16, y*16), tileimg.mask)
+        else:
+            baseimage.paste(tileimg, (x*16, y*16), tileimg)
+
+def timed(function, *args):
+    """ Runs the given function with the given arguments, returning
+    a tuple of the elapsed time (in seconds) and the function result.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+def benchmask(graphics):
+    """ Compares the original and current transparency masking methods
+    over every image in the given graphics file. Verifies that both
+    produce identical output.
+    """
+    originals = [image for record in graphics.records
+        for image in record.origimages]
+
+    (oldtime, oldimages) = timed(lambda: [legacymaskimage(image)
+        for image in originals])
+    (newtime, newimages) = timed(lambda: [imagerecord.maskimage(image)
+        for image in originals])
+
+    mismatches = sum(1 for (oldimage, newimage) in zip(oldimages, newimages)
+        if oldimage.tobytes() != newimage.tobytes())
+
+    print("Masked {} images".format(len(originals)))
+    print("  Original: {:8.3f} s".format(oldtime))
+    print("  Current:  {:8.3f} s ({:.1f}x)".format(newtime,
+        oldtime / newtime if newtime > 0 else float('inf')))
+    print("  Mismatched images: {}".format(mismatches))
+
+def benchtiles(graphicsname, tilesname, mapnames):
+    """ Compares the time taken to draw the tile layer of each map by
+    pasting tiles one at a time (the original method), by the current
+    paste path and by composing it from a tile atlas, for both RGB and
+    indexed graphics. Verifies that all three produce identical output.
+    """
+    tiledata = tilefile(tilesname)
+    for indexed in [False, True]:
+        graphics = imagefile(graphicsname, lazy=True, indexed=indexed)
+        print("{} tile layers:".format('Indexed' if indexed else 'RGB'))
+        for mapname in mapnames:
+            mapdata = xargonmap(mapname)
+            graphics.changepalette(mappalette(mapdata.epnum, mapdata.name))
+
+            # Every method starts from a blank map
+            if indexed:
+                (legacyimage, pasteimage, atlasimage) = [
+                    indexedcanvas((128*16, 64*16), 250).base for i in range(3)]
+            else:
+                (legacyimage, pasteimage, atlasimage) = [
+                    Image.new("RGB", (128*16, 64*16), graphics.getcolour(250))
+                    for i in range(3)]
+
+            # Resolve every tile once so decoding is not included
+            for tileval in set(mapdata.tiles):
+                tiledata.gettile(graphics, tileval)
+
+            (legacytime, result) = timed(legacypastetiles, legacyimage,
+                graphics, tiledata, mapdata)
+            (pastetime, result) = timed(xargonmapper.pastetiles, pasteimage,
+                graphics, tiledata, mapdata)
+            (atlastime, result) = timed(xargonmapper.composetiles, atlasimage,
+                graphics, tiledata, mapdata)
+
+            matches = legacyimage.tobytes() == pasteimage.tobytes() == \
+                atlasimage.tobytes()
+            print("  {:10} Original: {:7.2f} ms  Paste: {:7.2f} ms  "
+                "Atlas: {:7.2f} ms  {}".format(mapdata.name, legacytime*1000,
+                pastetime*1000, atlastime*1000,
+                'Match' if matches else 'MISMATCH'))
+
+def benchencode(graphicsname, tilesname, mapnames):
+    """ Times saving each map in every output format at the default,
+    fastest and smallest compression levels, reporting the total time
+    and file size for each over all the maps. Maps are composed with
+    indexed graphics, as needed for 256 colour PNG output, and the time
+    for 256 colour output includes matching the overlay to the palette.
+    """
+    graphics = imagefile(graphicsname, lazy=True, indexed=True)
+    tiledata = tilefile(tilesname)
+    settings = [(format, compresslevel)
+        for format in sorted(xargonmapper.formats)
+        for compresslevel in [None, 1, 9]]
+    totals = {setting: [0.0, 0] for setting in settings}
+
+    for mapname in mapnames:
+        mapper = xargonmapper(graphics, tiledata, xargonmap(mapname))
+        rgbimage = mapper.getimage()
+        for (format, compresslevel) in settings:
+            def encode():
+                outfile = io.BytesIO()
+                if format == 'png8':
+                    mapimage = mapper.getpalettedimage()
+                else:
+                    mapimage = rgbimage
+                saveimage(mapimage, outfile, format, compresslevel)
+                return len(outfile.getvalue())
+            (encodetime, size) = timed(encode)
+            totals[(format, compresslevel)][0] += encodetime
+            totals[(format, compresslevel)][1] += size
+
+    print("Encoded {} maps:".format(len(mapnames)))
+    for (format, compresslevel) in settings:
+        (encodetime, size) = totals[(format, compresslevel)]
+        print("  {:5} Level {:7}  Time: {:8.2f} s  Size: {:10.1f} KB".format(
+            format, 'default' if compresslevel is None else compresslevel,
+            encodetime, size / 1024))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ['mask', 'tiles', 'encode'] or \
+            (sys.argv[1] in ['tiles', 'encode'] and len(sys.argv) < 5):
+        print("""Usage: python xargonbench.py mask [Graphics File]
+       python xargonbench.py tiles [Graphics File] [Tiles File] [Map File(s)...]
+       python xargonbench.py encode [Graphics File] [Tiles File] [Map File(s)...]
+
+Runs performance benchmarks against Xargon data files:
+mask  : Times the transparency masking of every image in the specified
+        GRAPHICS file, comparing the original per-pixel method with the
+        current method and checking the results are identical.
+tiles : Times drawing the tile layer of each specified map, comparing
+        the original tile by tile paste, the current paste path and
+        composing the layer from a tile atlas, and checking the
+        results are identical.
+encode: Times saving each specified map in every output format (24 bit
+        PNG, 256 colour PNG and lossless WebP) at several compression
+        levels, reporting the total time and file size of each.
+""")
+    elif sys.argv[1] == 'mask':
+        benchmask(imagefile(sys.argv[2]))
+    elif sys.argv[1] == 'tiles':
+        benchtiles(sys.argv[2], sys.argv[3], sys.argv[4:])
+    elif sys.argv[1] == 'encode':
+        benchencode(sys.argv[2], sys.argv[3], sys.argv[4:])
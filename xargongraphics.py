@@ -18,24 +18,299 @@
 # If not, see <http://www.gnu.org/licenses/>.
 """ Module to interpret the Xargon graphics archive format. """
 
-import struct, sys, os, csv
-from PIL import Image, ImageFont, ImageDraw, ImageChops
+import struct, sys, os, csv, collections, hashlib, mmap
+from PIL import Image, ImageDraw, ImageChops
 
 def createpath(pathname):
     """ Simple utility method for creating a path only if it does
     not already exist.
     """
-    if not os.path.exists(pathname):
-        os.mkdir(pathname)
+    # Tolerate another process creating the path at the same time
+    os.makedirs(pathname, exist_ok=True)
+
+def mapfile(filename):
+    """ Maps the contents of the given file into memory, read only.
+    Returns a memoryview of the contents, which can be sliced without
+    copying. The mapping is shared with any other process reading
+    the same file.
+    """
+    with open(filename, 'rb') as infile:
+        # Empty files cannot be mapped
+        if os.fstat(infile.fileno()).st_size == 0:
+            return memoryview(b'')
+        # The mapping stays valid after the file is closed
+        return memoryview(mmap.mmap(infile.fileno(), 0,
+            access=mmap.ACCESS_READ))
+
+class glyphfont(object):
+    """ A fixed width font taken from a record of the GRAPHICS file,
+    which holds one image per character code. Text is composed from
+    an atlas of character masks, and the composed masks are kept for
+    reuse.
+    """
+    def __init__(self, record):
+        """ Builds the character atlas for this font:
+
+        record -- the imagerecord holding the character images. The
+                  character images use colour 3 as their background;
+                  any other colour is part of the character.
+        """
+        characters = record.origimages
+        (width, height) = characters[0].size
+        self.size = (width, height)
+
+        atlas = Image.new('P', (width*len(characters), height), 3)
+        for charnum, character in enumerate(characters):
+            atlas.paste(character, (charnum*width, 0))
+        inktable = bytes(0 if value == 3 else 255 for value in range(256))
+        self.atlas = Image.frombytes('L', atlas.size,
+            atlas.tobytes().translate(inktable))
+
+        # Only printable characters are used, as in the generated fonts
+        self.glyphs = {charnum: self.atlas.crop((charnum*width, 0,
+            (charnum + 1)*width, height))
+            for charnum in range(32, min(127, len(characters)))}
+        self.masks = {}
+
+    def getmask(self, text):
+        """ Renders the given text as a mask image, where the text is
+        opaque and everything else is transparent. Characters without
+        a glyph take up no space, each line ends at the first NUL
+        character, and each new line starts 4 pixels below the previous
+        one, the same as the PIL fonts made from the BDF files. Returns
+        None if the text has no visible size.
+
+        text -- the text to render, as a string or bytes
+        """
+        if text not in self.masks:
+            (width, height) = self.size
+            if isinstance(text, str):
+                lines = [[ord(char) for char in line] for line in text.split('\n')]
+            else:
+                lines = text.split(b'\n')
+            # Each line ends at the first NUL character, if any
+            lines = [line[:line.index(0)] if 0 in line else line
+                for line in lines]
+            lines = [[self.glyphs[charnum] for charnum in line
+                if charnum in self.glyphs] for line in lines]
+
+            maskwidth = max(len(line) for line in lines)*width
+            if maskwidth == 0:
+                mask = None
+            else:
+                mask = Image.new('L', (maskwidth, (len(lines) - 1)*(height + 4) + height))
+                for linenum, line in enumerate(lines):
+                    for charpos, glyph in enumerate(line):
+                        mask.paste(glyph, (charpos*width, linenum*(height + 4)))
+            self.masks[text] = mask
+        return self.masks[text]
+
+def drawtext(mappicture, position, text, font, fill):
+    """ Draws text into a map image. Works for both regular images and
+    indexed canvases.
+
+    mappicture -- the in-progress map image
+    position -- the upper-left corner of the text
+    text -- the text to draw
+    font -- the glyphfont to use
+    fill -- the text colour. An RGB tuple, or a palette index when
+            drawing into an indexed canvas.
+    """
+    mask = font.getmask(text)
+    if mask is not None:
+        mappicture.paste(fill, position, mask)
+
+# Outlined label images, keyed by text and font
+labelimages = {}
+
+def outlinedtext(text, font):
+    """ Renders the given text in white with a black outline, as used
+    for sprite labels. The outline is drawn one pixel out from each
+    corner of the text. Rendered labels are kept for reuse. Returns an
+    RGBA image, or None if the text has no visible size.
+    """
+    if (text, font) not in labelimages:
+        mask = font.getmask(text)
+        if mask is None:
+            outimage = None
+        else:
+            outimage = Image.new('RGBA', (mask.size[0] + 2, mask.size[1] + 2))
+            for offset in [(0, 0), (0, 2), (2, 0), (2, 2)]:
+                outimage.paste((0, 0, 0, 255), offset, mask)
+            outimage.paste((255, 255, 255, 255), (1, 1), mask)
+        labelimages[(text, font)] = outimage
+    return labelimages[(text, font)]
+
+def scaleimage(image, scale):
+    """ Shrinks an image to a fraction of its size, for drawing maps at
+    a lower resolution. Palette images and masks are shrunk by picking
+    the nearest pixel, so that no new colour indices or partially
+    transparent pixels are introduced. Other images are box filtered.
+    Images are never shrunk to less than one pixel across.
+
+    image -- the PIL image or keyedimage to shrink
+    scale -- the whole number to divide the width and height by
+    """
+    if isinstance(image, keyedimage):
+        return keyedimage(scaleimage(image.image, scale),
+            scaleimage(image.mask, scale), image.alpha)
+    (width, height) = image.size
+    size = (max(1, width // scale), max(1, height // scale))
+    if image.mode in ('P', 'L', '1'):
+        return image.resize(size, Image.NEAREST)
+    else:
+        return image.resize(size, Image.BOX)
+
+class palettematcher(object):
+    """ Converts RGB images into 256 colour images using a given palette
+    as it is, without choosing new colours or dithering. Pixels that
+    match a palette colour take the index of its first entry, and any
+    other pixels take the index of the closest colour. Each distinct
+    colour is only matched once, so the same matcher should be used
+    for all the images to be converted with a palette.
+    """
+    def __init__(self, palette):
+        """ Creates a matcher for the given palette, as a list or bytes
+        of RGB values.
+        """
+        self.palette = palette
+        self.colours = [tuple(palette[index*3:index*3 + 3])
+            for index in range(len(palette) // 3)]
+        self.indices = {}
+        for (index, colour) in enumerate(self.colours):
+            self.indices.setdefault(colour, index)
+
+    def nearest(self, colour):
+        """ Returns the index of the palette colour closest to the given
+        RGB colour.
+        """
+        (red, green, blue) = colour
+        return min(((red - r)**2 + (green - g)**2 + (blue - b)**2, index)
+            for (index, (r, g, b)) in enumerate(self.colours))[1]
+
+    def convert(self, image):
+        """ Converts the given RGB image. Returns the 256 colour image.
+        """
+        for (count, colour) in image.getcolors(image.size[0]*image.size[1]):
+            if colour not in self.indices:
+                self.indices[colour] = self.nearest(colour)
+
+        pixeldata = image.tobytes()
+        outimage = Image.new("P", image.size)
+        outimage.putpalette(self.palette)
+        outimage.frombytes(bytes(self.indices[colour] for colour in
+            zip(pixeldata[0::3], pixeldata[1::3], pixeldata[2::3])))
+        return outimage
+
+class keyedimage(object):
+    """ A 256 colour image paired with the mask of its non-transparent
+    pixels. Keyed images do not depend on the active palette, so they
+    can be composed before a palette is chosen.
+    """
+    def __init__(self, image, mask, alpha=255):
+        """ Initializes this keyed image:
+
+        image -- the 256 colour PIL image
+        mask -- an 'L' image with the opaque pixels set to 255
+        alpha -- the opacity of the whole image, where 0 is transparent
+                 and 255 is opaque.
+        """
+        self.image = image
+        self.mask = mask
+        self.alpha = alpha
+        self.size = image.size
+
+    def rgba(self, palette):
+        """ Converts this image into an RGBA image using the given
+        palette.
+        """
+        tempimage = self.image.copy()
+        tempimage.putpalette(palette)
+        outimage = tempimage.convert("RGBA")
+        outimage.putalpha(self.mask)
+        if self.alpha < 255:
+            outimage = imagefile.semitransparent(outimage, self.alpha)
+        return outimage
+
+class indexedcanvas(object):
+    """ A map image composed in 256 colour mode, with the palette
+    applied once at the end. Anything that cannot be represented with
+    palette indices (i.e. semi-transparent images and fixed colour
+    labels) is held back and drawn over the final image.
+    """
+    def __init__(self, size, background):
+        """ Creates an empty canvas of the given size, filled with
+        the given background palette index.
+        """
+        self.size = size
+        self.base = Image.new("P", size, background)
+        self.overlay = []
+
+    def paste(self, image, position, mask=None):
+        """ Pastes an image or colour into this canvas. Mirrors the
+        PIL paste method:
+
+        image -- a keyedimage, an RGBA image, an RGB colour tuple or a
+                 palette index.
+        position -- the upper-left corner to paste at
+        mask -- the mask to use. Ignored for keyed images, which
+                provide their own.
+        """
+        baseitem = self.baseitem(image, position, mask)
+        if baseitem is None:
+            self.overlay.append((image, position, mask))
+        else:
+            self.base.paste(*baseitem)
+
+    @staticmethod
+    def baseitem(image, position, mask=None):
+        """ Determines how an image or colour is pasted into the base
+        image of an indexed canvas. Returns a tuple of the image (or
+        palette index), position and mask to paste into the base image,
+        or None if it needs to go in the overlay instead.
+        """
+        if isinstance(image, keyedimage) and image.alpha == 255:
+            return (image.image, position, image.mask)
+        elif isinstance(image, int):
+            return (image, position, mask)
+        else:
+            return None
+
+    def overlayboxes(self):
+        """ Returns the boxes covered by each image and colour in the
+        overlay, clipped to the canvas, as (left, top, right, bottom)
+        tuples.
+        """
+        boxes = []
+        for (image, (x, y), mask) in self.overlay:
+            # Colours take their size from the mask
+            (width, height) = (mask if isinstance(image, (int, tuple))
+                else image).size
+            box = (max(x, 0), max(y, 0), min(x + width, self.size[0]),
+                min(y + height, self.size[1]))
+            if box[0] < box[2] and box[1] < box[3]:
+                boxes.append(box)
+        return boxes
+
+    def render(self, palette):
+        """ Applies the given palette to this canvas, then draws the
+        overlay on top. Returns the resulting RGB image.
+        """
+        tempimage = self.base.copy()
+        tempimage.putpalette(palette)
+        outimage = tempimage.convert("RGB")
+        for (image, position, mask) in self.overlay:
+            if isinstance(image, keyedimage):
+                image = image.rgba(palette)
+                mask = image
+            outimage.paste(image, position, mask)
+        return outimage
 
 class imagefile(object):
     """ Represents the Xargon GRAPHICS file, which contains all the images
     used by Xargon.
     """
-    debugfont = ImageFont.load("font1.pil")
-
-    @staticmethod
-    def debugimage(index, subindex, width, height):
+    def debugimage(self, index, subindex, width, height):
         """ Creates a debug image for sprites
 
         index -- the sprite index to identify with (main number)
@@ -50,29 +325,111 @@ class imagefile(object):
         pen = ImageDraw.Draw(tempimage)
         if width > 0 and height > 0:
             pen.rectangle(((0, 0), (width, height)), fill=(64, 64, 64, 128))
-        pen.text((imgwidth/2 - 22, imgheight/2 - 6), '{}:{}'.format(index,subindex),
-            font=imagefile.debugfont, fill=(255,255,255))
+        drawtext(tempimage, (int(imgwidth/2 - 22), int(imgheight/2 - 6)),
+            '{}:{}'.format(index,subindex), self.getfont(1), (255,255,255,255))
         return tempimage
 
-    def __init__(self, filename):
+    def getfont(self, fontnum):
+        """ Provides one of the two fonts stored in the graphics file,
+        creating it on first use. Font 1 is the 8x8 font and font 2
+        is the 6x6 font. Returns the glyphfont.
+        """
+        if fontnum not in self.fonts:
+            self.fonts[fontnum] = glyphfont(self.records[fontnum])
+        return self.fonts[fontnum]
+
+    # Identifies precompiled GRAPHICS cache files, and their format version
+    cachemagic = b'XARGONGC'
+    cacheversion = 2
+    cacheprefix = '<8sIQq20s20s128L128H'
+    cacherecord = '<?B4H3BiI'
+    cacheimage = '<IBB'
+
+    # Palette numbers, in the order they are stored in the cache
+    palettenums = list(range(21)) + [-1, -2]
+
+    def __init__(self, filename, cachelimit=64*1024*1024, lazy=False,
+            indexed=False, usecache=True):
         """ Loads the specified GRAPHICS file and decodes all images
         in the file,
-        """
 
-        filesize = os.path.getsize(filename)
-        graphicsfile = open(filename, 'rb')
+        filename -- the GRAPHICS file to load
+        cachelimit -- the approximate memory limit (in bytes) for the
+                      masked images kept for previously used palettes.
+        lazy -- if set, the images in each record are only decoded
+                the first time they are used.
+        indexed -- if set, the records provide keyed images for use
+                   with an indexed canvas instead of RGBA images.
+        usecache -- if set, the image data and palettes are loaded from
+                    a precompiled cache file next to the GRAPHICS file
+                    ([filename].cache). The cache is rebuilt whenever
+                    the GRAPHICS file or palette images change.
+        """
 
         self.epnum = int(filename[-1])
+        self.indexed = indexed
+
+        # Select the default palette according to episode for the
+        # image extraction method of operation.
+        if self.epnum == 2:
+            self.activepal = 6
+        elif self.epnum == 3:
+            self.activepal = 7
+        else:
+            self.activepal = 0
+
+        cachename = filename + '.cache'
+        cached = False
+        filedata = mapfile(filename)
+        if usecache:
+            cachekey = self.cachekey(filename, filedata)
+            cached = self.loadcache(cachename, cachekey, filedata)
+
+        if not cached:
+            self.loadgraphics(filedata)
+
+        # Load the image data
+        for recnum, record in enumerate(self.records):
+            if recnum == 53:
+                record.loadimages(self.palette[3], skipimages=1, lazy=lazy,
+                    indexed=indexed)
+            elif recnum == 5:
+                record.loadimages(self.palette[self.activepal], skipimages=1,
+                    lazy=lazy, indexed=indexed)
+            else:
+                record.loadimages(self.palette[self.activepal], lazy=lazy,
+                    indexed=indexed)
 
+        if usecache and not cached:
+            self.savecache(cachename, cachekey)
+
+        # Masked image sets keyed by palette number, in order of use.
+        # Each entry is a tuple of the memory used and the list of image
+        # lists for each record. Records that have not been masked
+        # with a palette yet have None in place of a list.
+        self.palcache = collections.OrderedDict()
+        self.cachelimit = cachelimit
+
+        # Fonts created from the graphics so far, keyed by font number
+        self.fonts = {}
+
+        # Sprite databases built from the graphics, keyed by episode
+        # number. Each entry also notes the palette it was built for.
+        self.spritedbs = {}
+
+    def loadgraphics(self, filedata):
+        """ Reads the record headers and palettes for a GRAPHICS file.
+
+        filedata -- a buffer holding the contents of the graphics file
+        """
         header = '<128L'
-        headerdata = struct.unpack(header,
-            graphicsfile.read(struct.calcsize(header)) )
+        headerdata = struct.unpack_from(header, filedata, 0)
         header2 = '<128H'
-        headerdata2 = struct.unpack(header2,
-            graphicsfile.read(struct.calcsize(header2)) )
+        headerdata2 = struct.unpack_from(header2, filedata,
+            struct.calcsize(header))
 
         # Create the image records using list comprehension
-        self.records = [imagerecord(graphicsfile, offset, size)
+        self.records = [imagerecord(filedata, offset, size)
             for (offset, size) in zip(headerdata, headerdata2)]
 
         # Load all image palettes from screenshots.
@@ -85,23 +442,139 @@ class imagefile(object):
         self.palette[-1] = self.records[5].getpalette()
         self.palette[-2] = self.records[53].getpalette()
 
-        # Select the default palette according to episode for the
-        # image extraction method of operation.
-        if self.epnum == 2:
-            self.activepal = 6
-        elif self.epnum == 3:
-            self.activepal = 7
-        else:
-            self.activepal = 0
+    @staticmethod
+    def cachekey(filename, filedata):
+        """ Determines the key identifying the current contents of a
+        GRAPHICS file and the palette images. Returns a tuple of the
+        file size, modification time, file hash and palette image hash.
+        """
+        filestat = os.stat(filename)
+        palhash = hashlib.sha1()
+        for i in range(21):
+            palstat = os.stat('palimage{}.png'.format(i))
+            palhash.update('{}:{}:{};'.format(i, palstat.st_size,
+                palstat.st_mtime_ns).encode())
+        return (filestat.st_size, filestat.st_mtime_ns,
+            hashlib.sha1(filedata).digest(), palhash.digest())
+
+    def loadcache(self, cachename, cachekey, filedata):
+        """ Loads the record headers, image locations and palettes from
+        a precompiled cache file. Returns False if there is no cache
+        file, or it does not match the given cache key or is damaged.
+
+        cachename -- the cache file to load
+        cachekey -- the key identifying the current GRAPHICS file
+        filedata -- a buffer holding the contents of the GRAPHICS file,
+                    which the records still read their headers from
+        """
+        try:
+            cachedata = mapfile(cachename)
+        except OSError:
+            return False
+
+        try:
+            return self.parsecache(cachedata, cachekey, filedata)
+        except struct.error:
+            return False
+
+    def parsecache(self, cachedata, cachekey, filedata):
+        """ Reads the contents of a cache file for loadcache. Returns
+        False if it does not match the given cache key or is incomplete.
+        """
+        prefixsize = struct.calcsize(self.cacheprefix)
+        if len(cachedata) < prefixsize:
+            return False
+        prefixdata = struct.unpack_from(self.cacheprefix, cachedata, 0)
+        if prefixdata[0:2] != (self.cachemagic, self.cacheversion) or \
+                prefixdata[2:6] != cachekey:
+            return False
+        (offsets, sizes) = (prefixdata[6:134], prefixdata[134:262])
+        position = prefixsize
+
+        recordsize = struct.calcsize(self.cacherecord)
+        recorddata = [struct.unpack_from(self.cacherecord, cachedata,
+            position + recnum*recordsize) for recnum in range(128)]
+        position += 128*recordsize
+
+        # Image data locations are stored relative to the data block
+        # at the end of the file.
+        imagesize = struct.calcsize(self.cacheimage)
+        numimages = sum(fields[-1] for fields in recorddata)
+        imagedata = list(struct.iter_unpack(self.cacheimage,
+            cachedata[position:position + imagesize*numimages]))
+        if len(imagedata) != numimages:
+            return False
+        position += imagesize*numimages
 
-        # Load the image data
-        for recnum, record in enumerate(self.records):
-            if recnum == 53:
-                record.loadimages(self.palette[3], skipimages=1)
-            elif recnum == 5:
-                record.loadimages(self.palette[self.activepal], skipimages=1)
+        self.palette = {}
+        for palnum in self.palettenums:
+            (palsize,) = struct.unpack_from('<H', cachedata, position)
+            paldata = bytes(cachedata[position + 2:position + 2 + palsize])
+            if len(paldata) != palsize:
+                return False
+            position += 2 + palsize
+            # Match the types loadgraphics provides for each palette
+            self.palette[palnum] = list(paldata) if palnum >= 0 else paldata
+        datastart = position
+        if datastart + sum(width*height for (dataoffset, width, height)
+                in imagedata) != len(cachedata):
+            return False
+
+        # The records keep reading their headers (and palettes) from the
+        # GRAPHICS file, and only take their image data from the cache.
+        self.records = []
+        for (offset, size, fields) in zip(offsets, sizes, recorddata):
+            header = fields[1:9] if fields[0] else None
+            record = imagerecord(filedata, offset, size, header, cachedata)
+            record.imageindex = [(datastart + dataoffset, width, height)
+                for (dataoffset, width, height) in imagedata[:fields[-1]]]
+            del imagedata[:fields[-1]]
+            record.leftover = fields[9]
+            record.reportleftover()
+            self.records.append(record)
+        return True
+
+    def savecache(self, cachename, cachekey):
+        """ Writes the record headers, image data and palettes of this
+        file to a precompiled cache file, so later runs can skip
+        parsing the GRAPHICS file and palette images.
+        """
+        recorddata = []
+        imagedata = []
+        blob = []
+        bloboffset = 0
+        for record in self.records:
+            if len(record.header) > 0:
+                recorddata.append(struct.pack(self.cacherecord, True,
+                    *record.header, record.leftover, len(record.imageindex)))
             else:
-                record.loadimages(self.palette[self.activepal])
+                recorddata.append(struct.pack(self.cacherecord, False,
+                    0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+            for (dataoffset, width, height) in record.imageindex:
+                imagedata.append(struct.pack(self.cacheimage, bloboffset,
+                    width, height))
+                blob.append(record.imagedata[dataoffset:dataoffset + width*height])
+                bloboffset += width*height
+
+        palettedata = []
+        for palnum in self.palettenums:
+            paldata = bytes(self.palette[palnum])
+            palettedata.append(struct.pack('<H', len(paldata)) + paldata)
+
+        offsets = [record.offset for record in self.records]
+        sizes = [record.size for record in self.records]
+        # Write to a temporary file first and move it into place, so any
+        # other process that has the old cache mapped is not disturbed.
+        tempname = '{}.{}.tmp'.format(cachename, os.getpid())
+        try:
+            with open(tempname, 'wb') as cachefile:
+                cachefile.write(struct.pack(self.cacheprefix, self.cachemagic,
+                    self.cacheversion, *cachekey, *offsets, *sizes))
+                cachefile.write(b''.join(recorddata + imagedata +
+                    palettedata + blob))
+            os.replace(tempname, cachename)
+        except OSError as err:
+            print("Unable to write graphics cache '{}': {}".format(cachename, err))
 
     def debug_csv(self, filename):
         """ Writes a debug CSV containing info on the records in this file."""
@@ -127,10 +600,39 @@ class imagefile(object):
         the specified pre-loaded palette number. Updates all masked
         images accordingly.
         """
-        if self.activepal != palnum:
+        if self.indexed:
+            # Keyed images do not depend on the palette.
             self.activepal = palnum
-            for record in self.records:
-                record.changepalette(self.palette[self.activepal])
+        elif self.activepal != palnum:
+            self.cachepalette()
+            self.activepal = palnum
+            if palnum in self.palcache:
+                # Previously used palette; reuse the masked images.
+                self.palcache.move_to_end(palnum)
+                (memsize, imagesets) = self.palcache[palnum]
+                for record, images in zip(self.records, imagesets):
+                    record.restoreimages(self.palette[self.activepal], images)
+            else:
+                for record in self.records:
+                    record.changepalette(self.palette[self.activepal])
+
+    def cachepalette(self):
+        """ Stores the masked images for the active palette in the
+        palette cache, then discards the least recently used palettes
+        until the cache fits inside the memory limit. The active palette
+        is never discarded.
+        """
+        imagesets = [record.masked for record in self.records]
+        memsize = sum(image.size[0] * image.size[1] * 4
+            for images in imagesets if images is not None
+            for image in images)
+        self.palcache[self.activepal] = (memsize, imagesets)
+        self.palcache.move_to_end(self.activepal)
+
+        totalsize = sum(entry[0] for entry in self.palcache.values())
+        while totalsize > self.cachelimit and len(self.palcache) > 1:
+            (palnum, (memsize, imagesets)) = self.palcache.popitem(last=False)
+            totalsize -= memsize
 
     def getcolour(self, index):
         """ Obtains the requested palette colour index from the currently
@@ -138,6 +640,16 @@ class imagefile(object):
         """
         return tuple(self.palette[self.activepal][index*3:index*3+3])
 
+    def getink(self, index):
+        """ Obtains the fill value to draw the requested palette colour
+        index with. This is the colour itself, or just the index when
+        working with indexed images.
+        """
+        if self.indexed:
+            return index
+        else:
+            return self.getcolour(index)
+
     def compositeimage(self, dimensions, imgrequests):
         """ Creates a combined image based on a set of individual images
         inside this graphics record:
@@ -148,6 +660,15 @@ class imagefile(object):
                        to the composite. The tuple contains, in order:
                        x offset, y offset, record number, image number
         """
+        if self.indexed:
+            tempimage = Image.new("P", dimensions)
+            tempmask = Image.new("L", dimensions)
+            for (x, y, recnum, imgnum) in imgrequests:
+                pasteimage = self.records[recnum].images[imgnum]
+                tempimage.paste(pasteimage.image, (x, y), pasteimage.mask)
+                tempmask.paste(pasteimage.mask, (x, y), pasteimage.mask)
+            return keyedimage(tempimage, tempmask)
+
         tempimage = Image.new("RGBA", dimensions)
         for (x, y, recnum, imgnum) in imgrequests:
             pasteimage = self.records[recnum].images[imgnum]
@@ -160,6 +681,8 @@ class imagefile(object):
         with the specified alpha value, where 0 is transparent and 255
         is opaque.
         """
+        if isinstance(inimage, keyedimage):
+            return keyedimage(inimage.image, inimage.mask, alpha)
         alphaimage = Image.new("RGBA", inimage.size, (255, 255, 255, alpha))
         return ImageChops.multiply(inimage, alphaimage)
 
@@ -171,40 +694,62 @@ class imagerecord(object):
         """ Masks colour 0 in the given image, turning those pixels
         transparent. Returns the resulting RGBA image.
         """
-        tempmask = Image.new('L', inimage.size, 255)
-        maskdata = list(tempmask.getdata())
-        outimage = inimage.convert("RGBA")
+        # Flag colour 0 as the transparent palette entry and let PIL
+        # apply it during the conversion, rather than visiting each
+        # pixel in Python. Work on a copy to leave the original alone.
+        tempimage = inimage.copy()
+        tempimage.info['transparency'] = 0
+        return tempimage.convert("RGBA")
 
-        for pos, value in enumerate(inimage.getdata()):
-            if value == 0:
-                maskdata[pos] = 0
-
-        tempmask.putdata(maskdata)
-        outimage.putalpha(tempmask)
-        return outimage
+    @staticmethod
+    def transparencymask(inimage):
+        """ Creates a mask for the given image where colour 0 is
+        transparent. Returns the resulting 'L' image.
+        """
+        tempimage = inimage.copy()
+        tempimage.info['transparency'] = 0
+        return tempimage.convert("LA").getchannel("A")
 
-    def __init__(self, filedata, offset, size):
+    def __init__(self, filedata, offset, size, header=None, imagedata=None):
         """ Loads the header information for this record, and all images
         described therein.
 
-        filedata -- an open file object to the graphics file.
+        filedata -- a buffer holding the contents of the graphics file
         offset -- the offset (in bytes) into the file for this record
         size -- the size of this record (in bytes)
+        header -- the record header, if it has already been read
+                  (i.e. from the graphics cache).
+        imagedata -- the buffer the image locations refer to, if it is
+                     not the graphics file (i.e. the graphics cache).
         """
         self.offset = offset
         self.size = size
 
-        self.images = []
-        self.origimages = []
-        # Store the file handle for future use
+        # Location and dimensions of each image inside the file. The
+        # decoded and masked images are filled in on demand.
+        self.imageindex = None
+        self.palette = None
+        self.decoded = None
+        self.coverage = None
+        self.masked = None
+        self.indexed = False
+        self.keyed = None
+        # Store the file buffer for future use. Records only ever read
+        # from fixed positions, so they are safe to decode concurrently.
         self.filedata = filedata
+        self.imagedata = filedata if imagedata is None else imagedata
+        # Bytes in this record not accounted for by its images (negative
+        # if the images read beyond the end of the record)
+        self.leftover = 0
+
+        if header is not None:
+            self.header = header
+            self.numimages = self.header[0] + 1
 
-        if offset > 0:
+        elif offset > 0:
             # Non-zero offsets have content to be loaded
-            filedata.seek(offset)
             headerstruct = '<B4H3B'
-            self.header = struct.unpack(headerstruct,
-                filedata.read(struct.calcsize(headerstruct)) )
+            self.header = struct.unpack_from(headerstruct, filedata, offset)
 
             self.numimages = self.header[0] + 1
 
@@ -213,56 +758,164 @@ class imagerecord(object):
             self.numimages = 0
             self.header = []
 
-    def loadimages(self, palette, skipimages=0):
+    def loadimages(self, palette, skipimages=0, lazy=False, indexed=False):
         """ Loads all the images inside this record.
 
         palette -- the palette to use for loading the images
         skipimages -- if > 0, this skips the specified number of images
+        lazy -- if set, only the image headers are read now. The image
+                data is decoded the first time it is used.
+        indexed -- if set, the images of this record are provided as
+                   keyed images rather than masked RGBA images.
         """
+        self.palette = palette
+        self.indexed = indexed
+        if self.imageindex is None:
+            self.imageindex = self.scanimages(skipimages)
+
+        if not lazy:
+            if indexed:
+                self.keyimages()
+            else:
+                self.maskimages()
+
+    def scanimages(self, skipimages=0):
+        """ Reads the header of each image in this record, then returns
+        a list of tuples containing the file offset of the image data,
+        the width and the height of each image.
+
+        skipimages -- if > 0, this skips the specified number of images
+        """
+        imageindex = []
         if self.offset > 0:
-            self.filedata.seek(self.offset + 12)
+            position = self.offset + 12
 
             for tilenum in range(self.numimages):
-                (width, height, unknown) = struct.unpack('<3B',
-                    self.filedata.read(3))
+                (width, height, unknown) = struct.unpack_from('<3B',
+                    self.filedata, position)
+                position += 3
                 # Skip past this image if requested (i.e. for palettes)
                 if skipimages > 0:
-                    self.filedata.seek(width*height, os.SEEK_CUR)
                     skipimages = skipimages - 1
                 elif width > 0 and height > 0:
-                    tile = Image.frombytes("P", (width, height),
-                        self.filedata.read(width*height))
-                    tile.putpalette(palette)
-                    self.origimages.append(tile)
-                    self.images.append(self.maskimage(tile))
+                    imageindex.append((position, width, height))
+                position += width*height
 
             # Check to see if we actually loaded all data from this record
-            leftover = self.offset + self.size - self.filedata.tell()
-            if leftover > 0:
-                print("Record at offset {} has {} bytes unaccounted for.".format(self.offset, leftover))
-            elif leftover < 0:
-                print("Record at offset {} read {} bytes beyond its boundary.".format(self.offset, -leftover))
+            self.leftover = self.offset + self.size - position
+            self.reportleftover()
+        return imageindex
+
+    def reportleftover(self):
+        """ Reports whether the images of this record did not match up
+        with its size.
+        """
+        if self.leftover > 0:
+            print("Record at offset {} has {} bytes unaccounted for.".format(self.offset, self.leftover))
+        elif self.leftover < 0:
+            print("Record at offset {} read {} bytes beyond its boundary.".format(self.offset, -self.leftover))
+
+    @property
+    def origimages(self):
+        """ The original 256 colour images in this record, decoded on
+        first use.
+        """
+        return self.decodeimages()
+
+    @property
+    def images(self):
+        """ The masked RGBA images in this record (or keyed images, if
+        this record is indexed), created from the original images on
+        first use.
+        """
+        if self.indexed:
+            return self.keyimages()
+        else:
+            return self.maskimages()
+
+    def decodeimages(self):
+        """ Decodes the original images in this record if this has not
+        been done yet. Returns the list of decoded images.
+        """
+        if self.decoded is None:
+            decoded = []
+            coverage = []
+            for (dataoffset, width, height) in self.imageindex:
+                # Wrap the pixel data in place rather than copying it
+                pixeldata = self.imagedata[dataoffset:dataoffset + width*height]
+                tile = Image.frombuffer("P", (width, height), pixeldata,
+                    'raw', 'P', 0, 1)
+                tile.putpalette(self.palette)
+                decoded.append(tile)
+
+                # Classify the image according to its colour 0 pixels
+                transparent = tile.histogram()[0]
+                if transparent == 0:
+                    coverage.append('opaque')
+                elif transparent == width*height:
+                    coverage.append('transparent')
+                else:
+                    coverage.append('mixed')
+            self.coverage = coverage
+            self.decoded = decoded
+        return self.decoded
+
+    def getcoverage(self, imgnum):
+        """ Determines how much of the given image is covered by
+        non-transparent pixels. Returns 'opaque' if the image has no
+        transparent pixels, 'transparent' if the image is entirely
+        transparent, or 'mixed' otherwise.
+        """
+        self.decodeimages()
+        return self.coverage[imgnum]
+
+    def maskimages(self):
+        """ Creates the masked images for this record using the current
+        palette if this has not been done yet. Returns the list of
+        masked images.
+        """
+        if self.masked is None:
+            self.masked = [self.maskimage(image) for image in self.decodeimages()]
+        return self.masked
+
+    def keyimages(self):
+        """ Creates the keyed images for this record if this has not
+        been done yet. Returns the list of keyed images.
+        """
+        if self.keyed is None:
+            self.keyed = [keyedimage(image, self.transparencymask(image))
+                for image in self.decodeimages()]
+        return self.keyed
 
     def changepalette(self, palette):
         """ Changes the palette used by this record object to
-        the specified palette. Updates all masked
-        images accordingly.
+        the specified palette. Masked images are recreated the next
+        time they are used.
+        """
+        self.restoreimages(palette, None)
+
+    def restoreimages(self, palette, images):
+        """ Changes the palette used by this record object to
+        the specified palette, using a list of images that were already
+        masked with that palette (or None to mask them again on demand).
         """
-        for imagepos, image in enumerate(self.origimages):
-            image.putpalette(palette)
-            self.images[imagepos] = self.maskimage(image)
+        self.palette = palette
+        if self.decoded is not None:
+            for image in self.decoded:
+                image.putpalette(palette)
+        self.masked = images
 
     def getpalette(self):
         """ Loads the first image in this record as a palette. Does
         not appear to fully decode the palette properly yet.
         """
-        self.filedata.seek(self.offset + 12)
-        (width, height, unknown) = struct.unpack('<3B',
-            self.filedata.read(3))
+        position = self.offset + 12
+        (width, height, unknown) = struct.unpack_from('<3B',
+            self.filedata, position)
         if width*height != 768:
             raise Exception('This image is not a palette!')
         else:
-            return self.filedata.read(width*height)
+            return bytes(self.filedata[position + 3:position + 3 + width*height])
 
     def save(self, outpath, recnum, masked=True):
         """ Saves all images in this record to the specified path.
@@ -276,7 +929,7 @@ class imagerecord(object):
         if self.numimages > 0:
             createpath(outpath)
             if (masked):
-                for tilenum, tile in enumerate(self.images):
+                for tilenum, tile in enumerate(self.maskimages()):
                     tile.save(os.path.join(outpath, '{:02}-{:04}.png'.format(recnum, tilenum)) )
             else:
                 for tilenum, tile in enumerate(self.origimages):
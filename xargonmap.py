@@ -18,73 +18,106 @@
 # If not, see <http://www.gnu.org/licenses/>.
 """ Module to interpret the Xargon map format. """
 
-import struct, sys, os, csv, pdb
+import struct, sys, os, csv, pdb, itertools
+from array import array
 from PIL import Image, ImageOps
 
 class xargonmap(object):
     """ Decodes the Xargon map file format. Represents a single level
     from Xargon.
     """
+    # Sprite types that are drawn as text
+    texttypes = {6, 7, 12, 61, 62}
+
     def __init__(self, filename):
         """ Loads the map data from the specified Xargon map file. """
 
-        # Grab the map from the file name (sans ext)
-        (temppath, tempfname) = os.path.split(filename)
-        (self.name, tempext) = os.path.splitext(tempfname)
+        (self.name, self.epnum) = self.parsefilename(filename)
 
-        self.epnum = int(tempext[-1])
+        # Read the whole map at once and decode it from the buffer
+        with open(filename, 'rb') as mapfile:
+            filedata = mapfile.read()
 
         # Load the map data as a 64*128 array of 16 bit values:
-        mapfile = open(filename, 'rb')
         pattern = '<{}H'.format(64*128)
+        self.tiles = struct.unpack_from(pattern, filedata, 0)
+        position = struct.calcsize(pattern)
 
-        self.tiles = struct.unpack(pattern,
-            mapfile.read(struct.calcsize(pattern)) )
-
-        # Decode the object header then the object list
-        objrecstruct = '<B15h'
+        # Decode the object header then the object list, all at once
+        objrecsize = struct.calcsize(objtable.recordformat)
 
-        (numobjs,) = struct.unpack('<H', mapfile.read(2) )
+        (numobjs,) = struct.unpack_from('<H', filedata, position)
+        position += 2
 
-        self.objs = [objrecord(struct.unpack(objrecstruct,
-            mapfile.read(struct.calcsize(objrecstruct)) ) )
-            for i in range(numobjs)]
+        self.objtable = objtable.unpack(filedata[position:position +
+            numobjs*objrecsize], numobjs)
+        position += numobjs*objrecsize
+        self.objs = list(map(objrecord, itertools.repeat(self.objtable, numobjs),
+            range(numobjs)))
 
-        # Create separate sprite and text lists:
-        self.text = [obj for obj in self.objs if obj.sprtype in [6, 7, 12, 61, 62] ]
-        self.sprites = [obj for obj in self.objs if obj.sprtype not in [6, 7, 12, 61, 62] ]
+        # Create separate sprite and text lists from the sprite types:
+        istext = [sprtype in self.texttypes for sprtype in self.objtable.columns[0]]
+        self.text = list(itertools.compress(self.objs, istext))
+        self.sprites = list(itertools.compress(self.objs,
+            [not text for text in istext]))
 
         # There always appears to be a 0x61 byte unknown region between
         # the records and strings. Let's just collect it as bytes for now.
         unknownregion = '<97B'
-        self.unknown = struct.unpack(unknownregion,
-            mapfile.read(struct.calcsize(unknownregion)) )
+        self.unknown = struct.unpack_from(unknownregion, filedata, position)
+        position += struct.calcsize(unknownregion)
 
         # The first byte appears to be the map number.
         self.mapnum = self.unknown[0]
 
         # Capture any strings until the end of the file
         self.strings = []
-        sizebytes = mapfile.read(2)
-        while (len(sizebytes) == 2):
-            (stringlen,) = struct.unpack('<H', sizebytes)
-            self.strings.append(mapfile.read(stringlen))
-            mapfile.read(1)
-            sizebytes = mapfile.read(2)
+        while position + 2 <= len(filedata):
+            (stringlen,) = struct.unpack_from('<H', filedata, position)
+            self.strings.append(filedata[position + 2:position + 2 + stringlen])
+            position += stringlen + 3
 
         # String reference lookup table. This is a bit of a hack for now.
         # Sort all known string references in reverse order:
-        self.stringlookup = [record.stringref for record in self.objs if record.stringref > 0]
+        self.stringlookup = [stringref for stringref in self.objtable.columns[13]
+            if stringref > 0]
         self.stringlookup.sort(reverse=True)
+        self.stringindex = {}
+        self.reindexstrings()
+
+    @staticmethod
+    def parsefilename(filename):
+        """ Determines the map name and episode number of an Xargon map
+        file from its file name, without loading the map. Returns a
+        tuple of the name and episode number.
+        """
+        # Grab the map from the file name (sans ext)
+        (temppath, tempfname) = os.path.split(filename)
+        (name, tempext) = os.path.splitext(tempfname)
+        return (name, int(tempext[-1]))
+
+    def reindexstrings(self, start=0):
+        """ Updates the index of string reference values after the
+        string lookup table has been changed. Only the entries from the
+        given position onward are reindexed, so changes near the end of
+        the table are cheap.
 
-        mapfile.close()
+        start -- the first position in the lookup table that changed
+        """
+        self.stringindex = {stringref: strindex
+            for (stringref, strindex) in self.stringindex.items()
+            if strindex < start}
+        for strindex in range(start, len(self.stringlookup)):
+            # Keep the first position for repeated reference values
+            self.stringindex.setdefault(self.stringlookup[strindex], strindex)
 
     def getstring(self, stringref):
         """ Attempts to determine the correct string for a given
         reference value, then returns the string.
         """
-        strindex = self.stringlookup.index(stringref)
-        return self.strings[strindex]
+        if stringref not in self.stringindex:
+            raise ValueError('{} is not in list'.format(stringref))
+        return self.strings[self.stringindex[stringref]]
 
     def debugcsv(self):
         """ Generates debug CSV files from the data in this map. """
@@ -128,16 +161,110 @@ class xargonmap(object):
         # ~ mapimage.save(self.name + '_flat.png')
 
 
+class objtable(object):
+    """ Holds the fields of all objects inside a map in columns, with one
+    list of values per field. Individual objects are accessed through
+    objrecord views. Columns are plain lists, as fields can be moved
+    outside the 16 bit range of the file (i.e. when stacked switches
+    are spread out).
+    """
+    # The layout of each object record in a map file
+    recordformat = '<B15h'
+
+    def __init__(self, columns):
+        """ Creates the table from a list of columns, each holding the
+        values of one field for every object.
+        """
+        self.columns = columns
+
+    @classmethod
+    def fromrecords(cls, records, numfields):
+        """ Creates the table from the given raw records:
+
+        records -- an iterable of tuples, each holding the raw field
+                   values of one object.
+        numfields -- the number of fields in each record
+        """
+        # Build each column in one step from the transposed records
+        rows = list(records)
+        if rows:
+            return cls([list(column) for column in zip(*rows)])
+        else:
+            return cls([[] for field in range(numfields)])
+
+    @classmethod
+    def unpack(cls, data, count):
+        """ Creates the table from the raw object records of a map file.
+        Each column is gathered straight from the record data, without
+        unpacking each record separately.
+
+        data -- the bytes holding the object records
+        count -- the number of object records
+        """
+        recordsize = struct.calcsize(cls.recordformat)
+        columns = [list(data[0::recordsize])]
+        fielddata = bytearray(2*count)
+        for field in range(15):
+            # Gather the low and high bytes of this field from every record
+            fielddata[0::2] = data[1 + 2*field::recordsize]
+            fielddata[1::2] = data[2 + 2*field::recordsize]
+            values = array('h', fielddata)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            columns.append(values.tolist())
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+def objfield(column, doc):
+    """ Creates a property giving access to a single column of the
+    object table for an objrecord.
+    """
+    def getfield(self):
+        return self.table.columns[column][self.index]
+    def setfield(self, value):
+        self.table.columns[column][self.index] = value
+    return property(getfield, setfield, doc=doc)
+
 class objrecord(object):
     """ Represents a single object (sprite, pickup) inside the map.
-    Decodes all identified fields.
+    Decodes all identified fields. This is a view onto a single row of
+    an objtable, so changes to the fields are kept in the table.
     """
-    def __init__(self, record):
-        self.rawdata = record
-        (self.sprtype, self.x, self.y, self.appearance, self.variant) = record[0:5]
-        (self.width, self.height, self.subtype) = record[5:8]
-        self.info = record[10]
-        self.stringref = record[13]
+    __slots__ = ('table', 'index')
+
+    def __init__(self, record, index=None):
+        """ Creates the object record:
+
+        record -- the objtable holding this object. Alternatively, a
+                  tuple of raw field values, for objects that are not
+                  part of a map file.
+        index -- the row of this object in the table. Must be omitted
+                 when creating an object from raw field values.
+        """
+        if index is None:
+            self.table = objtable.fromrecords([record], len(record))
+            self.index = 0
+        else:
+            self.table = record
+            self.index = index
+
+    @property
+    def rawdata(self):
+        """ The raw field values of this object, as a tuple. """
+        return tuple(column[self.index] for column in self.table.columns)
+
+    sprtype = objfield(0, "The sprite type of this object")
+    x = objfield(1, "The horizontal position of this object, in pixels")
+    y = objfield(2, "The vertical position of this object, in pixels")
+    appearance = objfield(3, "The appearance of this object")
+    variant = objfield(4, "The variant of this object")
+    width = objfield(5, "The width of this object, in pixels")
+    height = objfield(6, "The height of this object, in pixels")
+    subtype = objfield(7, "The sprite subtype of this object")
+    info = objfield(10, "The info value of this object (i.e. door links)")
+    stringref = objfield(13, "The string reference value of this object")
 
 
 if __name__ == "__main__":
@@ -20,18 +20,143 @@
 level in Xargon.
 """
 
-import sys, os
+import sys, os, io, argparse, contextlib, functools, multiprocessing, traceback
+import hashlib, json, math
+from multiprocessing.pool import ThreadPool
 from PIL import Image
 from xargonmap import xargonmap, objrecord
-from xargongraphics import imagefile, createpath
+from xargongraphics import imagefile, indexedcanvas, keyedimage, createpath, \
+    scaleimage, outlinedtext, palettematcher
 from xargontiles import tilefile
-from spritedb import spritedb
+from spritedb import spritedb, loadtable
+
+def mappalette(epnum, name):
+    """ Selects the correct colour palette number for a map, based on its
+    episode number and name.
+    """
+    name = name.upper()
+    if epnum == 2:
+        # Episode 2
+        if name in ['BOARD_01', 'BOARD_08', 'BOARD_15', 'BOARD_32']:
+            return 8
+        elif name in ['BOARD_03']:
+            return 9
+        elif name in ['BOARD_05']:
+            return 10
+        elif name in ['BOARD_07']:
+            return 11
+        elif name in ['BOARD_10']:
+            return 13
+        elif name in ['BOARD_11']:
+            return 12
+        else:
+            return 6
+    elif epnum == 3:
+        # Episode 3
+        if name in ['BOARD_01']:
+            return 14
+        elif name in ['BOARD_02']:
+            return 15
+        elif name in ['BOARD_03']:
+            return 16
+        elif name in ['BOARD_07']:
+            return 17
+        elif name in ['BOARD_11']:
+            return 18
+        elif name in ['BOARD_13']:
+            return 19
+        elif name in ['BOARD_12']:
+            return 20
+        else:
+            return 7
+    else:
+        # Episode 1
+        if name in ['BOARD_01', 'BOARD_02', 'BOARD_04']:
+            return 0
+        elif name == 'DEMO3':
+            return 2
+        elif name == 'BOARD_05':
+            return 4
+        elif name in ['BOARD_08', 'BOARD_33']:
+            return 5
+        else:
+            return 1
+
+def preprocessmap(mapdata):
+    """ Performs some minor corrections on the map in order to
+    work around some incomplete interpretations, and also to
+    ensure a cleaner map image. Runs in linear time with respect to
+    the number of objects in the map.
+
+    mapdata -- the xargonmap to correct. It is modified in place.
+    """
+    # First loop: find all door info values
+    doorinfos = {objrec.info for objrec in mapdata.sprites
+        if objrec.sprtype == 9}
+
+    # Second loop: Erase switches that align with doors and move doubled
+    # up sprites 8 pixels down until they reach a free location.
+    # Locations are encoded as a single number, so moving down a step
+    # is a fixed increment.
+    stepdown = 8*128*16
+    switchlocations = set()
+    # Taken locations point at a later location to continue searching
+    # from, so stacks of switches are not walked repeatedly.
+    nextlocation = {}
+    for objrec in mapdata.text:
+        if objrec.sprtype == 12:
+            start = objrec.x + objrec.y*128*16
+            location = start
+            visited = []
+            while location in switchlocations:
+                visited.append(location)
+                location = nextlocation.get(location, location + stepdown)
+            for taken in visited:
+                nextlocation[taken] = location
+            objrec.y += (location - start) // (128*16)
+            switchlocations.add(location)
+            if objrec.info in doorinfos:
+                objrec.info = 0
+
+    # String adjust for STORY map:
+    if mapdata.name.upper() == 'STORY' and mapdata.epnum == 1:
+        page3to5 = mapdata.stringlookup[117:120]
+        page6 = mapdata.stringlookup[82]
+        page7 = mapdata.stringlookup[81]
+        page8 = mapdata.stringlookup[84]
+        page9 = mapdata.stringlookup[83]
+        page10 = mapdata.stringlookup[116]
+
+        del mapdata.stringlookup[116:120]
+        del mapdata.stringlookup[81:85]
+
+        mapdata.stringlookup[81:81] = page3to5 + [page6, page7, page8, page9, page10]
+        mapdata.reindexstrings(81)
+
+    # String adjust for Episode 2 Ending:
+    if mapdata.name.upper() == 'BOARD_32' and mapdata.epnum == 2:
+        blank = mapdata.stringlookup[-1]
+
+        del mapdata.stringlookup[-1]
+        mapdata.stringlookup.insert(8, blank)
+        mapdata.reindexstrings(8)
+
+    # Fake Sprite for Episode 3 Ending:
+    if mapdata.name.upper() == 'BOARD_32' and mapdata.epnum == 3:
+        mapdata.sprites.append(objrecord( (1000, 48, 240, 0, 0, 160, 160,
+            0, 0, 0, 0, 0, 0, 0, 0) ))
 
 class xargonmapper(object):
     """ The main Xargon mapper class. This will generate
     a map image for a given Xargon stage.
     """
-    def __init__(self, graphics, tiledata, mapdata):
+    # Supported map scales, each dividing the 16 pixel tiles evenly
+    scales = (1, 2, 4, 8, 16)
+    # Supported output formats, with the file extension for each
+    formats = {'png': '.png', 'png8': '.png', 'webp': '.webp'}
+
+    def __init__(self, graphics, tiledata, mapdata, useatlas=True, bands=1,
+            scale=1):
         """ Initializes and generates a map image for the provided map.
 
         graphics -- a xargongraphics object representing all the
@@ -39,150 +164,718 @@ class xargonmapper(object):
         tiledata -- a xargontile objrect containing the tile to image
                     mappings for this episode of Xargon.
         mapdata -- a xargonmap object to generate an image map for.
+        useatlas -- if set, the tile layer is composed in one pass from
+                    a tile atlas where possible, rather than pasting
+                    each tile separately.
+        bands -- the number of horizontal bands to split the map into
+                 for drawing the sprites, where each band is drawn on
+                 a separate thread.
+        scale -- draws the map this many times smaller than full size
+                 (1, 2, 4, 8 or 16), from tiles and sprite images that
+                 are shrunk before they are drawn.
         """
+        if scale not in self.scales:
+            raise Exception('Unsupported map scale {}'.format(scale))
 
         self.name = mapdata.name
         self.epnum = mapdata.epnum
+        self.scale = scale
 
         # Select the correct colour palette.
-        if self.epnum == 2:
-            # Episode 2
-            if self.name.upper() in ['BOARD_01', 'BOARD_08',
-                    'BOARD_15', 'BOARD_32']:
-                graphics.changepalette(8)
-            elif self.name.upper() in ['BOARD_03']:
-                graphics.changepalette(9)
-            elif self.name.upper() in ['BOARD_05']:
-                graphics.changepalette(10)
-            elif self.name.upper() in ['BOARD_07']:
-                graphics.changepalette(11)
-            elif self.name.upper() in ['BOARD_10']:
-                graphics.changepalette(13)
-            elif self.name.upper() in ['BOARD_11']:
-                graphics.changepalette(12)
-            else:
-                graphics.changepalette(6)
-        elif self.epnum == 3:
-            # Episode 3
-            if self.name.upper() in ['BOARD_01']:
-                graphics.changepalette(14)
-            elif self.name.upper() in ['BOARD_02']:
-                graphics.changepalette(15)
-            elif self.name.upper() in ['BOARD_03']:
-                graphics.changepalette(16)
-            elif self.name.upper() in ['BOARD_07']:
-                graphics.changepalette(17)
-            elif self.name.upper() in ['BOARD_11']:
-                graphics.changepalette(18)
-            elif self.name.upper() in ['BOARD_13']:
-                graphics.changepalette(19)
-            elif self.name.upper() in ['BOARD_12']:
-                graphics.changepalette(20)
-            else:
-                graphics.changepalette(7)
+        graphics.changepalette(mappalette(self.epnum, self.name))
+
+        # Indexed graphics are composed with colour indices, and the
+        # palette is only applied when saving.
+        self.palette = graphics.palette[graphics.activepal]
+        self.palettes = graphics.palette
+        mapsize = (128*16 // scale, 64*16 // scale)
+        if graphics.indexed:
+            self.mappicture = indexedcanvas(mapsize, 250)
+            baseimage = self.mappicture.base
         else:
-            # Episode 1
-            if self.name.upper() in ['BOARD_01', 'BOARD_02', 'BOARD_04']:
-                graphics.changepalette(0)
-            elif self.name.upper() == 'DEMO3':
-                graphics.changepalette(2)
-            elif self.name.upper() == 'BOARD_05':
-                graphics.changepalette(4)
-            elif self.name.upper() in ['BOARD_08', 'BOARD_33']:
-                graphics.changepalette(5)
-            else:
-                graphics.changepalette(1)
+            self.mappicture = Image.new("RGB", mapsize, graphics.getcolour(250) )
+            baseimage = self.mappicture
+        sprites = spritedb.shared(graphics, mapdata.epnum)
+
+        preprocessmap(mapdata)
 
-        self.mappicture = Image.new("RGB", (128*16, 64*16), graphics.getcolour(250) )
-        sprites = spritedb(graphics, mapdata.epnum)
+        if not useatlas or not self.composetiles(baseimage, graphics,
+                tiledata, mapdata, scale):
+            self.pastetiles(baseimage, graphics, tiledata, mapdata, scale)
+
+        if bands > 1:
+            self.drawbands(sprites, mapdata, bands)
+        else:
+            for objrecord in mapdata.sprites:
+                sprites.drawsprite(self.mappicture, objrecord, mapdata, scale)
+            for objrecord in mapdata.text:
+                sprites.drawsprite(self.mappicture, objrecord, mapdata, scale)
 
-        self.preprocessmap(mapdata)
+    def drawbands(self, sprites, mapdata, bands):
+        """ Draws the sprites and text of the map in horizontal bands,
+        each on its own thread, then stitches the bands back into the
+        map image. The result is identical to drawing the whole map at
+        once, as the objects overlapping each band are drawn into it in
+        their original order.
 
-        for index, tileval in enumerate(mapdata.tiles):
-            # Remember: maps are height first
-            (x, y) = (index//64, index%64)
+        sprites -- the sprite database to draw the objects with
+        mapdata -- the xargonmap being drawn
+        bands -- the number of bands to split the map into
+        """
+        if isinstance(self.mappicture, indexedcanvas):
+            baseimage = self.mappicture.base
+        else:
+            baseimage = self.mappicture
+        (width, height) = baseimage.size
+        bandheight = -(-height // bands)
+        bands = -(-height // bandheight)
+
+        # Resolve every object in order, so any problems are reported in
+        # the usual order, and index the results by the bands they cover.
+        banditems = [[] for band in range(bands)]
+        for objrecord in mapdata.sprites + mapdata.text:
+            for (image, position, mask) in sprites.resolvesprite(objrecord,
+                    mapdata, self.scale):
+                if isinstance(self.mappicture, indexedcanvas):
+                    item = indexedcanvas.baseitem(image, position, mask)
+                    if item is None:
+                        # Overlay items are drawn over the final image
+                        self.mappicture.overlay.append((image, position, mask))
+                        continue
+                    (image, position, mask) = item
+                itemheight = (mask if mask is not None else image).size[1]
+                top = max(position[1], 0)
+                bottom = min(position[1] + itemheight, height)
+                for band in range(top // bandheight, (bottom - 1) // bandheight + 1):
+                    banditems[band].append((image, position, mask))
+
+        def drawband(band):
+            bandtop = band*bandheight
+            bandimage = baseimage.crop((0, bandtop, width,
+                min(bandtop + bandheight, height)))
+            for (image, (x, y), mask) in banditems[band]:
+                bandimage.paste(image, (x, y - bandtop), mask)
+            return bandimage
+
+        with ThreadPool(bands) as pool:
+            bandimages = pool.map(drawband, range(bands))
+        for (band, bandimage) in enumerate(bandimages):
+            baseimage.paste(bandimage, (0, band*bandheight))
+
+    @staticmethod
+    def pastetiles(baseimage, graphics, tiledata, mapdata, scale=1):
+        """ Draws the map tiles into the base map image by pasting them.
+        Fully transparent tiles are skipped, fully opaque tiles are
+        pasted without a mask, and vertical runs of the same tile are
+        pasted as a single strip. Strips are shrunk by the given scale
+        before they are pasted.
+        """
+        strips = {}
+        for x in range(128):
+            # Remember: maps are height first, so each column of the
+            # map is a contiguous slice of the tile list.
+            column = mapdata.tiles[x*64:(x+1)*64]
+            y = 0
+            while y < 64:
+                tileval = column[y]
+                runlength = 1
+                while y + runlength < 64 and column[y + runlength] == tileval:
+                    runlength += 1
+
+                coverage = tiledata.getcoverage(graphics, tileval)
+                if coverage != 'transparent':
+                    if (tileval, runlength) not in strips:
+                        (stripimage, stripmask) = xargonmapper.tilestrip(
+                            tiledata.gettile(graphics, tileval), runlength)
+                        if scale > 1:
+                            if stripmask is stripimage:
+                                stripimage = stripmask = scaleimage(stripimage, scale)
+                            else:
+                                stripimage = scaleimage(stripimage, scale)
+                                stripmask = scaleimage(stripmask, scale)
+                        strips[(tileval, runlength)] = (stripimage, stripmask)
+                    (stripimage, stripmask) = strips[(tileval, runlength)]
+                    position = (x*16 // scale, y*16 // scale)
+                    if coverage == 'opaque':
+                        baseimage.paste(stripimage, position)
+                    else:
+                        baseimage.paste(stripimage, position, stripmask)
+                y += runlength
+
+    @staticmethod
+    def tilestrip(tileimg, count):
+        """ Creates a vertical strip of the given tile image repeated
+        the given number of times. Returns a tuple of the strip image
+        and its mask.
+        """
+        if isinstance(tileimg, keyedimage):
+            (image, mask) = (tileimg.image, tileimg.mask)
+        else:
+            (image, mask) = (tileimg, tileimg)
+        if count == 1:
+            return (image, mask)
+
+        (width, height) = image.size
+        stripimage = Image.new(image.mode, (width, height*count))
+        for i in range(count):
+            stripimage.paste(image, (0, i*height))
+        if mask is image:
+            # RGBA images are their own mask
+            return (stripimage, stripimage)
+
+        stripmask = Image.new(mask.mode, (width, height*count))
+        for i in range(count):
+            stripmask.paste(mask, (0, i*height))
+        return (stripimage, stripmask)
+
+    @staticmethod
+    def composetiles(baseimage, graphics, tiledata, mapdata, scale=1):
+        """ Composes the whole tile layer in a single pass, replacing
+        the contents of the given base image. Each distinct tile value
+        is resolved once into an atlas of rows of pixel data, already
+        flattened over the background colour and shrunk by the given
+        scale. The layer is then gathered from the atlas and loaded
+        into the image at once.
+
+        Returns False without changing anything if the tiles are not
+        all 16x16, in which case they need to be pasted instead.
+        """
+        # Build the atlas from the background colour in the base image.
+        background = baseimage.getpixel((0, 0))
+        tilesize = 16 // scale
+        atlas = {}
+        for tileval in set(mapdata.tiles):
             tileimg = tiledata.gettile(graphics, tileval)
-            self.mappicture.paste(tileimg, (x*16, y*16), tileimg )
-
-        for objrecord in mapdata.sprites:
-            sprites.drawsprite(self.mappicture, objrecord, mapdata)
-        for objrecord in mapdata.text:
-            sprites.drawsprite(self.mappicture, objrecord, mapdata)
-
-    def preprocessmap(self, mapdata):
-        """ Performs some minor corrections on the map in order to
-        work around some incomplete interpretations, and also to
-        ensure a cleaner map image.
-        """
-        switchlocations = []
-        doorinfos = []
-
-        # First loop: find all door info values
-        for objrec in mapdata.sprites:
-            if objrec.sprtype == 9:
-                doorinfos.append(objrec.info)
-
-        # Second loop: Erase switches that align with doors and move doubled up sprites.
-        for objrec in mapdata.text:
-            if objrec.sprtype == 12:
-                while (objrec.x + objrec.y*128*16) in switchlocations:
-                    objrec.y += 8
-                switchlocations.append(objrec.x + objrec.y*128*16)
-                if objrec.info in doorinfos:
-                    objrec.info = 0
-
-        # String adjust for STORY map:
-        if mapdata.name.upper() == 'STORY' and mapdata.epnum == 1:
-            page3to5 = mapdata.stringlookup[117:120]
-            page6 = mapdata.stringlookup[82]
-            page7 = mapdata.stringlookup[81]
-            page8 = mapdata.stringlookup[84]
-            page9 = mapdata.stringlookup[83]
-            page10 = mapdata.stringlookup[116]
-
-            del mapdata.stringlookup[116:120]
-            del mapdata.stringlookup[81:85]
-
-            mapdata.stringlookup[81:81] = page3to5 + [page6, page7, page8, page9, page10]
-
-        # String adjust for Episode 2 Ending:
-        if mapdata.name.upper() == 'BOARD_32' and mapdata.epnum == 2:
-            blank = mapdata.stringlookup[-1]
-
-            del mapdata.stringlookup[-1]
-            mapdata.stringlookup.insert(8, blank)
-
-        # Fake Sprite for Episode 3 Ending:
-        if mapdata.name.upper() == 'BOARD_32' and mapdata.epnum == 3:
-            mapdata.sprites.append(objrecord( (1000, 48, 240, 0, 0, 160, 160,
-                0, 0, 0, 0, 0, 0, 0, 0) ))
+            if tileimg.size != (16, 16):
+                return False
+            flatimage = Image.new(baseimage.mode, (16, 16), background)
+            if isinstance(tileimg, keyedimage):
+                flatimage.paste(tileimg.image, (0, 0), tileimg.mask)
+            else:
+                flatimage.paste(tileimg, (0, 0), tileimg)
+            if scale > 1:
+                flatimage = scaleimage(flatimage, scale)
+            pixeldata = flatimage.tobytes()
+            rowsize = len(pixeldata) // tilesize
+            atlas[tileval] = [pixeldata[row*rowsize:(row+1)*rowsize]
+                for row in range(tilesize)]
 
-    def save(self):
+        # Remember: maps are height first, so each column of the map
+        # is a contiguous slice of the tile list.
+        columns = [mapdata.tiles[x*64:(x+1)*64] for x in range(128)]
+        layerdata = []
+        for y in range(64):
+            rowtiles = [atlas[column[y]] for column in columns]
+            for row in range(tilesize):
+                layerdata.append(b''.join([tilerows[row] for tilerows in rowtiles]))
+
+        baseimage.frombytes(b''.join(layerdata))
+        return True
+
+    def save(self, palnum=None, format='png', compresslevel=None):
         """ Saves the generated map to a folder based on episode,
         and name based on the input map filename.
+
+        palnum -- if provided, saves a variant of the map using this
+                  palette number instead of the map's own palette. The
+                  palette number is added to the file name.
+        format -- the output format, as for saveimage
+        compresslevel -- the compression level, as for saveimage
+
+        Returns the path of the saved image.
         """
-        epfolder = 'Episode{}'.format(self.epnum)
-        createpath(epfolder)
-        self.mappicture.save(os.path.join(epfolder, self.name + '.png'))
+        createpath('Episode{}'.format(self.epnum))
+        outputname = self.outputpath(self.epnum, self.name, palnum,
+            self.formats[format], self.scale)
+        if format == 'png8':
+            mapimage = self.getpalettedimage(palnum)
+        else:
+            mapimage = self.getimage(palnum)
+        saveimage(mapimage, outputname, format, compresslevel)
+        return outputname
 
+    def savetiles(self, palnum=None, tilesize=256, format='png',
+            compresslevel=None):
+        """ Saves the generated map as a pyramid of square tiles for pan
+        and zoom web viewers, using the XYZ layout of
+        [mapname]_tiles/[zoom]/[x]/[y].png in the episode folder. The
+        deepest zoom level is the full size map, each level above it is
+        downsampled to half the size of the one below, and level 0 fits
+        the whole map in one tile. Tiles on the right and bottom edges
+        are padded with black. Tiles are saved using a pool of threads.
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("""Usage: python xargonmapper.py [Graphics File] [Tiles File] [Map File(s)...]
-
-Generates map images for every Xargon map file indicated. Requires the
-corresponding GRAPHICS file for the images to use, and the TILES file
-for the map tile to graphics resource mapping. All files should be from
-the same Episode of Xargon.
-""")
+        palnum -- as for save, with the palette number added to the
+                  name of the tile folder.
+        tilesize -- the width and height of each tile in pixels
+        format -- the output format of the tiles, as for saveimage
+        compresslevel -- the compression level, as for saveimage
+
+        Returns the paths of the saved tiles.
+        """
+        tilefolder = self.outputpath(self.epnum, self.name, palnum, '_tiles',
+            self.scale)
+        if format == 'png8':
+            levelimage = self.getpalettedimage(palnum)
+        else:
+            levelimage = self.getimage(palnum)
+        levels = [levelimage]
+        while max(levelimage.size) > tilesize:
+            # 256 colour levels are shrunk without introducing new colours
+            levelimage = scaleimage(levelimage, 2)
+            levels.insert(0, levelimage)
+
+        tiles = []
+        for (zoom, levelimage) in enumerate(levels):
+            (width, height) = levelimage.size
+            for x in range(-(-width // tilesize)):
+                createpath(os.path.join(tilefolder, str(zoom), str(x)))
+                for y in range(-(-height // tilesize)):
+                    tiles.append((zoom, x, y))
+
+        def savetile(tile):
+            (zoom, x, y) = tile
+            tilename = os.path.join(tilefolder, str(zoom), str(x),
+                '{}{}'.format(y, self.formats[format]))
+            saveimage(levels[zoom].crop((x*tilesize, y*tilesize,
+                (x + 1)*tilesize, (y + 1)*tilesize)), tilename, format,
+                compresslevel)
+            return tilename
+
+        with ThreadPool() as pool:
+            return pool.map(savetile, tiles)
+
+    @staticmethod
+    def outputpath(epnum, name, palnum=None, suffix='.png', scale=1):
+        """ Returns the path that save uses for a map image.
+
+        epnum -- the episode number of the map
+        name -- the name of the map
+        palnum -- the palette number of a palette variant, if any
+        suffix -- the extension (or other suffix) added to the name
+        scale -- the scale of a reduced size map, if any
+        """
+        if scale > 1:
+            name = '{}_scale{}'.format(name, scale)
+        if palnum is None:
+            filename = name + suffix
+        else:
+            filename = '{}_pal{}{}'.format(name, palnum, suffix)
+        return os.path.join('Episode{}'.format(epnum), filename)
+
+    def getimage(self, palnum=None):
+        """ Returns the generated map as an RGB image.
+
+        palnum -- if provided, the palette number to use instead of the
+                  map's own palette. Only available for indexed maps.
+        """
+        if isinstance(self.mappicture, indexedcanvas):
+            if palnum is None:
+                return self.mappicture.render(self.palette)
+            else:
+                return self.mappicture.render(self.palettes[palnum])
+        elif palnum is None:
+            return self.mappicture
+        else:
+            raise Exception('Palette variants require an indexed map.')
+
+    def getpalettedimage(self, palnum=None):
+        """ Returns the generated map as a 256 colour image using the
+        map's own palette, or the given palette number. Only available
+        for indexed maps. The composed colour indices are used as they
+        are, and only the areas drawn over the top are matched to the
+        palette.
+        """
+        if not isinstance(self.mappicture, indexedcanvas):
+            raise Exception('256 colour output requires an indexed map.')
+        palette = self.getpalette(palnum)
+        outimage = self.mappicture.base.copy()
+        outimage.putpalette(palette)
+        if len(self.mappicture.overlay) > 0:
+            rgbimage = self.getimage(palnum)
+            matcher = palettematcher(palette)
+            for box in self.mappicture.overlayboxes():
+                outimage.paste(matcher.convert(rgbimage.crop(box)), box[:2])
+        return outimage
+
+    def getpalette(self, palnum=None):
+        """ Returns the map's own palette, or the given palette number.
+        """
+        if palnum is None:
+            return self.palette
+        else:
+            return self.palettes[palnum]
+
+
+def saveimage(image, filename, format='png', compresslevel=None):
+    """ Saves a map image in one of the supported output formats:
+
+    image -- the RGB image to save, or the 256 colour image from
+             getpalettedimage for 'png8'
+    filename -- the file name (or file object) to save to
+    format -- 'png' for a 24 bit PNG, 'png8' for a 256 colour PNG, or
+              'webp' for a lossless WebP
+    compresslevel -- the compression level from 0 (fastest) to 9
+                     (smallest), or None for the default. Scaled to the
+                     0 to 6 methods for WebP.
+    """
+    options = {}
+    if format == 'webp':
+        options['lossless'] = True
+        if compresslevel is not None:
+            options['method'] = compresslevel*6 // 9
+        image.save(filename, 'WEBP', **options)
     else:
-        xargonimages = imagefile(sys.argv[1])
+        if compresslevel is not None:
+            options['compress_level'] = compresslevel
+        image.save(filename, 'PNG', **options)
+
+def filedigest(filename):
+    """ Returns the SHA-1 hex digest of the contents of a file. """
+    with open(filename, 'rb') as infile:
+        return hashlib.sha1(infile.read()).hexdigest()
+
+class rendermanifest(object):
+    """ Records the inputs each map of an episode was last rendered from
+    and the images that were saved, so that unchanged maps can be
+    skipped. Stored as Episode#.manifest.json next to the Episode#
+    output folder.
+    """
+
+    def __init__(self, epnum):
+        """ Loads the manifest for the given episode, if there is one.
+        """
+        self.filename = 'Episode{}.manifest.json'.format(epnum)
+        try:
+            with open(self.filename, 'r') as manifestfile:
+                self.maps = json.load(manifestfile)
+        except (OSError, ValueError):
+            self.maps = {}
+
+    @staticmethod
+    def inputdigest(filename, sharedinputs):
+        """ Determines the digest identifying everything a map image is
+        rendered from.
+
+        filename -- the map file
+        sharedinputs -- a list of the digests and options shared by
+                        every map (GRAPHICS, TILES, palette images,
+                        sprite table, etc)
+        """
+        (name, epnum) = xargonmap.parsefilename(filename)
+        inputs = [filedigest(filename), mappalette(epnum, name)] + sharedinputs
+        return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+    def isuptodate(self, name, inputs):
+        """ Checks whether a map was last rendered from the same inputs
+        and its saved images have not changed since.
+        """
+        entry = self.maps.get(name)
+        if entry is None or entry['inputs'] != inputs:
+            return False
+        for (outputname, outputkey) in entry['outputs'].items():
+            try:
+                outputstat = os.stat(outputname)
+            except OSError:
+                return False
+            if [outputstat.st_size, outputstat.st_mtime_ns] != outputkey:
+                return False
+        return True
+
+    def record(self, name, inputs, outputs):
+        """ Records the inputs and saved images for a rendered map. """
+        outputkeys = {}
+        for outputname in outputs:
+            outputstat = os.stat(outputname)
+            outputkeys[outputname] = [outputstat.st_size, outputstat.st_mtime_ns]
+        self.maps[name] = {'inputs': inputs, 'outputs': outputkeys}
+
+    def save(self):
+        """ Saves the manifest. Written to a temporary file first so an
+        interrupted run never leaves a partial manifest.
+        """
+        tempname = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tempname, 'w') as manifestfile:
+            json.dump(self.maps, manifestfile, indent=1, sort_keys=True)
+        os.replace(tempname, self.filename)
+
+
+class contactsheet(object):
+    """ A single image showing many maps in a grid, each captioned with
+    its name. Maps are added one at a time as they are generated, so
+    only the sheet itself needs to be kept in memory. The size of each
+    cell is taken from the first map added.
+    """
+
+    def __init__(self, filename, count, font, columns=None, spacing=4):
+        """ Prepares an empty contact sheet:
+
+        filename -- the file to save the sheet to
+        count -- the number of maps the sheet holds
+        font -- the glyphfont to caption each map with
+        columns -- the number of maps across the sheet. By default the
+                   grid is made roughly square for 2:1 maps.
+        spacing -- the gap in pixels between maps
+        """
+        self.filename = filename
+        self.count = count
+        self.font = font
+        if columns is None:
+            columns = math.ceil(math.sqrt(count / 2))
+        self.columns = max(1, min(columns, count))
+        self.rows = -(-count // self.columns)
+        self.spacing = spacing
+        self.image = None
+
+    def add(self, index, mapimage, caption):
+        """ Adds a map image to the given cell of the sheet, counting
+        across then down, with a caption in the upper-left corner.
+        """
+        (width, height) = mapimage.size
+        if self.image is None:
+            self.cellsize = (width, height)
+            self.image = Image.new("RGB",
+                (self.columns*(width + self.spacing) - self.spacing,
+                self.rows*(height + self.spacing) - self.spacing))
+        (cellwidth, cellheight) = self.cellsize
+        (row, column) = divmod(index, self.columns)
+        (x, y) = (column*(cellwidth + self.spacing),
+            row*(cellheight + self.spacing))
+        self.image.paste(mapimage.crop((0, 0, cellwidth, cellheight)), (x, y))
+
+        label = outlinedtext(caption, self.font)
+        if label is not None:
+            self.image.paste(label, (x + 1, y + 1), label)
+
+    def save(self):
+        """ Saves the sheet, if any maps were added to it. Returns
+        whether the sheet was saved.
+        """
+        if self.image is None:
+            return False
+        self.image.save(self.filename)
+        return True
+
 
-        tiledata = tilefile(sys.argv[2])
-        for filename in sys.argv[3:]:
+# Graphics and tile data shared by every map rendered in this process.
+workergraphics = None
+workertiles = None
+
+def initworker(graphicsname, tilesname, indexed):
+    """ Loads the GRAPHICS and TILES files used for rendering maps in
+    this process. Called once for each batch worker process.
+    """
+    global workergraphics, workertiles
+    workergraphics = imagefile(graphicsname, lazy=True, indexed=indexed)
+    workertiles = tilefile(tilesname)
+
+def rendermap(job, palettes, bands=1, pyramid=False, scale=1,
+        sheet=False, format='png', compresslevel=None):
+    """ Generates and saves the map image(s) for a single map file using
+    the graphics loaded by initworker. Any output is captured so that
+    it can be reported in order by the main process.
+
+    job -- a tuple of the position of the map in the list being
+           rendered and the map file to render
+    palettes -- a list of palette numbers to save variants for, where
+                None is the map's own palette.
+    bands -- the number of horizontal bands to draw each map in
+    pyramid -- if set, saves a tile pyramid for each image instead of
+               a single image.
+    scale -- draws each map this many times smaller than full size
+    sheet -- if set, the generated map is returned for a contact sheet
+             instead of being saved.
+    format -- the output format, as for saveimage
+    compresslevel -- the compression level, as for saveimage
+
+    Returns a tuple of the position of the map, the file name, the
+    captured output, whether the map was generated successfully and the
+    paths of the saved images. For a contact sheet, the last item holds
+    the xargonmapper instead, so the palette variants can be produced
+    one at a time when they are added to the sheet.
+    """
+    (mapnum, filename) = job
+    log = io.StringIO()
+    success = True
+    outputs = []
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
             themap = xargonmap(filename)
 
             print("Generating Map '{}'".format(themap.name))
-            mapper = xargonmapper(xargonimages, tiledata, themap)
-            print("Saving Map '{}'".format(themap.name))
-            mapper.save()
+            mapper = xargonmapper(workergraphics, workertiles, themap,
+                bands=bands, scale=scale)
+            if sheet:
+                outputs.append(mapper)
+                palettes = []
+            else:
+                print("Saving Map '{}'".format(themap.name))
+            for palnum in palettes:
+                if pyramid:
+                    outputs.extend(mapper.savetiles(palnum, format=format,
+                        compresslevel=compresslevel))
+                else:
+                    outputs.append(mapper.save(palnum, format, compresslevel))
+        except Exception:
+            traceback.print_exc()
+            success = False
+    return (mapnum, filename, log.getvalue(), success, outputs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""Generates map images
+        for every Xargon map file indicated. Requires the corresponding
+        GRAPHICS file for the images to use, and the TILES file for the
+        map tile to graphics resource mapping. All files should be from
+        the same Episode of Xargon.""")
+    parser.add_argument('graphics', metavar='GRAPHICS',
+        help='the GRAPHICS file for this episode')
+    parser.add_argument('tiles', metavar='TILES',
+        help='the TILES file for this episode')
+    parser.add_argument('maps', metavar='MAP', nargs='+',
+        help='the map file(s) to generate images for')
+    parser.add_argument('--indexed', action='store_true',
+        help="""compose each map using 256 colour indices and apply
+        the palette once at the end. Semi-transparent sprites and
+        labels are drawn over the top of everything else.""")
+    parser.add_argument('--palettes', metavar='LIST',
+        help="""save a variant of each map for every palette in this
+        comma-separated list of palette numbers (or 'all'), instead of
+        the map's own palette. Implies --indexed.""")
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+        help="""render up to N maps at once using a pool of worker
+        processes. Each worker loads the GRAPHICS and TILES files
+        once.""")
+    parser.add_argument('--bands', metavar='N', type=int, default=1,
+        help="""draw the sprites and text of each map in N horizontal
+        bands at once, using a pool of threads.""")
+    parser.add_argument('--incremental', action='store_true',
+        help="""skip maps whose inputs (map, GRAPHICS and TILES files,
+        palette, sprite table and options) and saved images are
+        unchanged since they were last rendered, as recorded in
+        Episode#.manifest.json.""")
+    parser.add_argument('--pyramid', action='store_true',
+        help="""save each map as a pyramid of 256 pixel tiles at every
+        zoom level for web viewers, in [mapname]_tiles/[z]/[x]/[y].png,
+        instead of a single image.""")
+    parser.add_argument('--scale', metavar='N', type=int, default=1,
+        choices=xargonmapper.scales,
+        help="""draw each map N times smaller than full size (1, 2, 4,
+        8 or 16), shrinking the tiles and sprite images once before
+        they are drawn. Saved as [mapname]_scaleN.png.""")
+    parser.add_argument('--sheet', metavar='FILE',
+        help="""save a single contact sheet image showing every map in
+        a grid, instead of an image for each map. Maps are added to the
+        sheet as they finish, so combine this with --scale to keep the
+        sheet small.""")
+    parser.add_argument('--sheet-columns', metavar='N', type=int,
+        help="""the number of maps across the contact sheet. By default
+        the sheet is roughly square.""")
+    parser.add_argument('--format', default='png',
+        choices=sorted(xargonmapper.formats),
+        help="""the format to save maps in: a 24 bit PNG (the default),
+        a 256 colour PNG using the map's palette without quantisation
+        (png8, implies --indexed), or a lossless WebP.""")
+    parser.add_argument('--compress-level', metavar='N', type=int,
+        choices=range(10),
+        help="""the compression level from 0 (fastest) to 9 (smallest).
+        Scaled to the 0 to 6 methods for WebP.""")
+    args = parser.parse_args()
+    if args.sheet is not None and (args.incremental or args.pyramid):
+        parser.error('--sheet cannot be used with --incremental or --pyramid')
+
+    indexed = args.indexed or args.palettes is not None or \
+        args.format == 'png8'
+    initworker(args.graphics, args.tiles, indexed)
+
+    if args.palettes is None:
+        palettes = [None]
+    elif args.palettes == 'all':
+        palettes = sorted(workergraphics.palette)
+    else:
+        palettes = []
+        for palnum in args.palettes.split(','):
+            try:
+                palettes.append(int(palnum))
+            except ValueError:
+                parser.error('invalid palette number {!r}'.format(palnum))
+            if palettes[-1] not in workergraphics.palette:
+                parser.error('unknown palette number {}'.format(palettes[-1]))
+
+    # Work out which maps need rendering
+    mapnames = args.maps
+    if args.incremental:
+        sharedinputs = [filedigest(args.graphics), filedigest(args.tiles),
+            [filedigest('palimage{}.png'.format(i)) for i in range(21)],
+            loadtable().version, indexed, palettes, args.pyramid, args.scale,
+            args.format, args.compress_level]
+        manifests = {}
+        mapinputs = {}
+        mapnames = []
+        for filename in args.maps:
+            (name, epnum) = xargonmap.parsefilename(filename)
+            if epnum not in manifests:
+                manifests[epnum] = rendermanifest(epnum)
+            mapinputs[filename] = rendermanifest.inputdigest(filename,
+                sharedinputs)
+            if manifests[epnum].isuptodate(name, mapinputs[filename]):
+                print("Skipping unchanged Map '{}'".format(name))
+            else:
+                mapnames.append(filename)
+
+    render = functools.partial(rendermap, palettes=palettes, bands=args.bands,
+        pyramid=args.pyramid, scale=args.scale, sheet=args.sheet is not None,
+        format=args.format, compresslevel=args.compress_level)
+    if args.sheet is not None:
+        # One cell for each palette variant of each map
+        sheet = contactsheet(args.sheet, len(mapnames)*len(palettes),
+            workergraphics.getfont(1), args.sheet_columns)
+    if args.jobs > 1 and len(mapnames) > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=initworker,
+            initargs=(args.graphics, args.tiles, indexed))
+        results = pool.imap_unordered(render, enumerate(mapnames))
+    else:
+        pool = None
+        results = map(render, enumerate(mapnames))
+
+    # Handle each map as soon as it is finished, but report on them in
+    # the order given, regardless of which worker finished first. Only
+    # the output of maps finished early is held back.
+    failures = []
+    logs = {}
+    nextlog = 0
+    for (mapnum, filename, log, success, outputs) in results:
+        if not success:
+            failures.append(mapnum)
+        elif args.sheet is not None:
+            (name, epnum) = xargonmap.parsefilename(filename)
+            mapper = outputs[0]
+            for (palindex, palnum) in enumerate(palettes):
+                caption = name if palnum is None else '{} pal{}'.format(name, palnum)
+                sheet.add(mapnum*len(palettes) + palindex,
+                    mapper.getimage(palnum), caption)
+        elif args.incremental:
+            (name, epnum) = xargonmap.parsefilename(filename)
+            manifests[epnum].record(name, mapinputs[filename], outputs)
+        outputs = mapper = None
+
+        logs[mapnum] = log
+        while nextlog in logs:
+            sys.stdout.write(logs.pop(nextlog))
+            sys.stdout.flush()
+            nextlog += 1
+
+    if args.incremental:
+        for manifest in manifests.values():
+            manifest.save()
+    if args.sheet is not None and sheet.save():
+        print("Saved contact sheet '{}'".format(args.sheet))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if len(failures) > 0:
+        print("Failed to generate {} of {} maps:".format(len(failures), len(mapnames)))
+        for mapnum in sorted(failures):
+            print("  {}".format(mapnames[mapnum]))
+        sys.exit(1)
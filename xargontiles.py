@@ -53,9 +53,10 @@ class tilefile(object):
 
             self.lookup[headerdata[0]] = headerdata[1]
 
-    def gettile(self, graphics, tilenum):
-        """ Finds the correct tile image from the provided graphics
-        object corresponding to the provided tile number.
+    def gettileref(self, tilenum):
+        """ Finds the graphics record number and image number
+        corresponding to the provided tile number. Returns them
+        as a tuple.
         """
         # Most tiles numbers appear to be offset by 0xC000, for some reason.
         if tilenum < 0xC000:
@@ -67,8 +68,23 @@ class tilefile(object):
         recnum = graphindex // 256 - 64
         recindex = graphindex % 256
 
+        return (recnum, recindex)
+
+    def gettile(self, graphics, tilenum):
+        """ Finds the correct tile image from the provided graphics
+        object corresponding to the provided tile number.
+        """
+        (recnum, recindex) = self.gettileref(tilenum)
         return graphics.records[recnum].images[recindex]
 
+    def getcoverage(self, graphics, tilenum):
+        """ Determines whether the tile image for the provided tile
+        number is 'opaque', 'transparent' or 'mixed'. See
+        imagerecord.getcoverage.
+        """
+        (recnum, recindex) = self.gettileref(tilenum)
+        return graphics.records[recnum].getcoverage(recindex)
+
     def debug_csv(self, filename):
         """ Writes a debug csv containing the fields in this TILES file."""
         with open(filename, 'w', newline='') as csvfile: